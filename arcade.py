@@ -0,0 +1,204 @@
+"""Plays up to MAX_BOARDS games side by side in one window, each played by the computer or by a player with own keys.
+
+Usage: uv run arcade.py [--boards 16] [--players 2] [--seed N] [--window 1600x900 | --fullscreen] [--profile]"""
+import argparse
+import math
+import random
+import time
+
+import pygame
+
+from tetris import (ARR_MS, AUTOPLAY_RESTART_MS, DAS_MS, FPS, STEP_MS, Autoplayer, Game, GameState, Profiler,
+                    StaticLayer, VirtualClock, advance_game, draw_game, get_bg, layout_scale, restart_game,
+                    write_text_lines)
+
+MAX_BOARDS = 16
+# the keys of every player and the game keys they stand for, the boards of the first players are played with them and
+# the others by the computer
+PLAYER_KEYS = (
+    {pygame.K_LEFT: pygame.K_LEFT, pygame.K_RIGHT: pygame.K_RIGHT, pygame.K_DOWN: pygame.K_DOWN,
+     pygame.K_UP: pygame.K_SPACE, pygame.K_RSHIFT: pygame.K_d},
+    {pygame.K_a: pygame.K_LEFT, pygame.K_d: pygame.K_RIGHT, pygame.K_s: pygame.K_DOWN, pygame.K_w: pygame.K_SPACE,
+     pygame.K_LSHIFT: pygame.K_d},
+    {pygame.K_j: pygame.K_LEFT, pygame.K_l: pygame.K_RIGHT, pygame.K_k: pygame.K_DOWN, pygame.K_i: pygame.K_SPACE,
+     pygame.K_SPACE: pygame.K_d},
+    {pygame.K_KP4: pygame.K_LEFT, pygame.K_KP6: pygame.K_RIGHT, pygame.K_KP5: pygame.K_DOWN,
+     pygame.K_KP8: pygame.K_SPACE, pygame.K_KP0: pygame.K_d},
+)
+WINDOW_SIZE = 1600, 900
+
+
+def parse_size(text: str) -> tuple[int, int]:
+    try:
+        width, height = map(int, text.lower().split('x'))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}") from err
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError("the window size must be positive")
+    return width, height
+
+
+def grid_shape(boards: int, size: tuple[int, int]) -> tuple[int, int]:
+    """Returns the (columns, rows) of tiles that shows "boards" boards the largest on a screen of "size" """
+    return max(((cols, math.ceil(boards / cols)) for cols in range(1, boards + 1)),
+               key=lambda shape: layout_scale((size[0] // shape[0], size[1] // shape[1])))
+
+
+class Tile:
+    """One board of the arcade: its game, where it is drawn and who plays it, "keys" maps the player's keys to game
+    keys, None if the computer plays"""
+
+    def __init__(self, game: Game, keys: dict[int, int] | None):
+        self.game = game
+        self.game_state = GameState()
+        self.game_state.started = True
+        self.keys = keys
+        if keys is None:
+            game.autoplayer = Autoplayer()
+        self.rect = pygame.Rect(0, 0, 0, 0)
+        # time since the game was over and whether the game over screen was drawn
+        self.dead_ms = 0
+        self.game_over_shown = False
+
+
+class Arcade:
+    """Runs the games of all the boards in a single frame loop in one window. Every board draws straight into its own
+    subsurface of the window and only the regions of the boards that changed are presented. The boards share the
+    event pump, the font and text caches, the block tiles and the background of tetris.py."""
+
+    def __init__(self, screen: pygame.Surface, boards=MAX_BOARDS, players=0, seed=None, das_ms=DAS_MS, arr_ms=ARR_MS):
+        if not 1 <= boards <= MAX_BOARDS:
+            raise ValueError(f"an arcade has 1 to {MAX_BOARDS} boards, not {boards}")
+        if not 0 <= players <= min(boards, len(PLAYER_KEYS)):
+            raise ValueError(f"{players} players can't play on {boards} boards")
+        seeds = random.Random(seed)
+        self.static_layer = StaticLayer()
+        self.tiles = []
+        for i in range(boards):
+            game = Game((1, 1), headless=True, clock=VirtualClock(), seed=seeds.randrange(2 ** 32), das_ms=das_ms,
+                        arr_ms=arr_ms)
+            # every tile has the same size, so the background and the grid are only composited once for all of them
+            game.static_layer = self.static_layer
+            self.tiles.append(Tile(game, PLAYER_KEYS[i] if i < players else None))
+        self.bg = get_bg()
+        self.profiler = Profiler()
+        self.running = True
+        self.layout(screen)
+
+    def layout(self, screen: pygame.Surface):
+        """Arranges the boards in a grid of equal tiles, centered on "screen" """
+        self.screen = screen
+        self.size = screen.get_size()
+        cols, rows = grid_shape(len(self.tiles), self.size)
+        width, height = self.size[0] // cols, self.size[1] // rows
+        left, top = (self.size[0] - cols * width) // 2, (self.size[1] - rows * height) // 2
+        screen.fill((0, 0, 0))
+        for i, tile in enumerate(self.tiles):
+            tile.rect = pygame.Rect(left + i % cols * width, top + i // cols * height, width, height)
+            tile.game.resize(screen.subsurface(tile.rect))
+            if tile.game_state.dead:
+                self.draw_game_over(tile)
+        self.full_screen = True
+
+    def frame(self, frame_ms: int):
+        """Handles the events, advances every game by "frame_ms" and draws and presents the boards that changed"""
+        start = frame_start = self.profiler.start()
+        for event in pygame.event.get():
+            self.handle(event)
+        start = self.profiler.lap('input', start)
+        for tile in self.tiles:
+            if tile.game_state.dead:
+                tile.dead_ms += frame_ms
+                if tile.dead_ms > AUTOPLAY_RESTART_MS:
+                    self.restart(tile)
+            else:
+                advance_game(tile.game, tile.game_state, frame_ms)
+        start = self.profiler.lap('update', start)
+        rects = []
+        for tile in self.tiles:
+            game = tile.game
+            if tile.game_state.dead and not tile.game_over_shown:
+                self.draw_game_over(tile)
+                game.dirty_rects.invalidate()
+            elif not tile.game_state.dead:
+                draw_game(self.bg, game, tile.game_state, game.accumulator / STEP_MS)
+            rects.extend(rect.move(tile.rect.topleft) for rect in game.dirty_rects.take())
+        start = self.profiler.lap('sprites', start)
+        if self.full_screen:
+            pygame.display.flip()
+            self.full_screen = False
+        elif rects:
+            pygame.display.update(rects)
+        self.profiler.lap('present', start)
+        self.profiler.end_frame(frame_start)
+
+    def handle(self, event: pygame.event.Event):
+        if event.type == pygame.QUIT or event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.running = False
+        elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            for tile in self.tiles:
+                if tile.keys and event.key in tile.keys:
+                    if tile.game_state.dead and event.type == pygame.KEYDOWN:
+                        self.restart(tile)
+                    else:
+                        tile.game.keyboard.handle(pygame.event.Event(event.type, key=tile.keys[event.key]))
+
+    def restart(self, tile: Tile):
+        restart_game(tile.game, tile.game_state)
+        tile.game.accumulator = 0
+        tile.dead_ms = 0
+        tile.game_over_shown = False
+
+    @staticmethod
+    def draw_game_over(tile: Tile):
+        tile.game_over_shown = True
+        tile.game.screen.fill((0, 0, 0))
+        write_text_lines(['Game Over!', f'Score: {tile.game_state.score}'], tile.game.screen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--boards', type=int, default=MAX_BOARDS, help=f"number of boards, up to {MAX_BOARDS}")
+    parser.add_argument('--players', type=int, default=0,
+                        help=f"boards played with the keyboard, up to {len(PLAYER_KEYS)}: arrows, up rotates and right "
+                             "shift drops / WASD and left shift / IJKL and space / keypad 4568 and 0")
+    parser.add_argument('--seed', type=int, help="seed of the piece sequences of all the boards, random by default")
+    parser.add_argument('--window', type=parse_size, default=WINDOW_SIZE, metavar='WxH',
+                        help=f"initial window size (default {WINDOW_SIZE[0]}x{WINDOW_SIZE[1]}), it can be resized")
+    parser.add_argument('--fullscreen', action='store_true', help="use the whole display")
+    parser.add_argument('--fps', type=int, default=FPS, help=f"frame rate limit, 0 for none (default {FPS})")
+    parser.add_argument('--duration', type=float, help="quit after this many seconds")
+    parser.add_argument('--profile', action='store_true',
+                        help="print the p50/p95/p99 times of the stages of the frames at exit")
+    args = parser.parse_args()
+    if not 1 <= args.boards <= MAX_BOARDS:
+        parser.error(f"--boards must be between 1 and {MAX_BOARDS}")
+    if not 0 <= args.players <= min(args.boards, len(PLAYER_KEYS)):
+        parser.error(f"--players must be between 0 and {min(args.boards, len(PLAYER_KEYS))}")
+
+    pygame.display.init()
+    pygame.font.init()
+    pygame.display.set_caption("Tetris arcade")
+    flags = pygame.FULLSCREEN if args.fullscreen else pygame.RESIZABLE
+    screen = pygame.display.set_mode((0, 0) if args.fullscreen else args.window, flags)
+    arcade = Arcade(screen, args.boards, args.players, args.seed)
+    arcade.profiler.enabled = args.profile
+
+    clock = pygame.time.Clock()
+    end = time.perf_counter() + args.duration if args.duration else float('inf')
+    clock.tick()
+    while arcade.running and time.perf_counter() < end:
+        frame_ms = clock.tick(args.fps)
+        if (screen := pygame.display.get_surface()).get_size() != arcade.size:
+            arcade.layout(screen)
+        arcade.frame(frame_ms)
+
+    if args.profile:
+        print(f'{arcade.profiler.frames} frames, ms   p50    p95    p99')
+        for stage in arcade.profiler.stages():
+            print(f'{stage:<10} ' + ' '.join(f'{ms:6.2f}' for ms in arcade.profiler.percentiles(stage)))
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Batched game engine stepping many boards at once with NumPy, for training and evaluating placement policies."""
+import numpy as np
+
+from tetris import BLOCKS_HORIZONTAL, BLOCKS_VERTICAL, LINE_SCORE, PIECE_ROTATIONS, PIECE_SCORE, WALL_KICKS
+
+NOOP, LEFT, RIGHT, ROTATE, DOWN, DROP = range(6)
+NR_ACTIONS = 6
+
+
+def _cells_table() -> np.ndarray:
+    """Returns the piece rotation states as an array indexed by [piece type, rotation, cell, (column, row)]. Pieces with
+    less than 4 states repeat them and pieces with less than 4 cells repeat their cells."""
+    table = np.zeros((len(PIECE_ROTATIONS) + 1, 4, 4, 2), dtype=np.int16)
+    for piece_type, states in PIECE_ROTATIONS.items():
+        for rotation in range(4):
+            cells = states[rotation % len(states)]
+            table[piece_type, rotation] = (cells * 4)[:4]
+    return table
+
+
+CELLS = _cells_table()
+# rotation states of every piece type, the rotation index of a piece is taken modulo this
+NR_ROTATIONS = np.array([1] + [len(PIECE_ROTATIONS[piece_type]) for piece_type in sorted(PIECE_ROTATIONS)])
+KICKS = np.array(WALL_KICKS, dtype=np.int16)
+# columns and lowest row the spawned pieces cover in PIECE_ROTATIONS, for a board BLOCKS_HORIZONTAL wide
+SPAWN_LEFT = min(col for states in PIECE_ROTATIONS.values() for col, _ in states[0])
+SPAWN_RIGHT = max(col for states in PIECE_ROTATIONS.values() for col, _ in states[0])
+SPAWN_BOTTOM = max(row for states in PIECE_ROTATIONS.values() for _, row in states[0])
+
+
+class BatchEnv:
+    """Holds "n" independent boards as an (n, height, width) array and steps all of them with one action each.
+
+    Every step applies the action, then gravity moves the pieces one row down. Pieces that can't move down are locked,
+    complete lines are cleared and scored like in the game and a new piece is spawned. Boards whose game ended are
+    reported in "dones" and reset automatically. New pieces spawn centered on the board, like in the game."""
+
+    def __init__(self, n: int, seed=None, width=BLOCKS_HORIZONTAL, height=BLOCKS_VERTICAL):
+        # columns new pieces are moved right of their PIECE_ROTATIONS cells, centering them on width // 2
+        self.spawn_dx = (width - BLOCKS_HORIZONTAL) // 2
+        if SPAWN_LEFT + self.spawn_dx < 0 or SPAWN_RIGHT + self.spawn_dx >= width or SPAWN_BOTTOM >= height:
+            raise ValueError(f"board size {width}x{height} is too small for the pieces")
+        self.n = n
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        self.boards = np.zeros((n, height, width), dtype=np.uint8)
+        self.piece_types = np.ones(n, dtype=np.int16)
+        self.rotations = np.zeros(n, dtype=np.int16)
+        # offset of the pieces from their cells in PIECE_ROTATIONS
+        self.x = np.zeros(n, dtype=np.int16)
+        self.y = np.zeros(n, dtype=np.int16)
+        self.scores = np.zeros(n, dtype=np.int64)
+        self.lines = np.zeros(n, dtype=np.int64)
+        # score of the last finished game of every board
+        self.final_scores = np.zeros(n, dtype=np.int64)
+        self._all = np.arange(n)
+        self.reset()
+
+    def reset(self, mask: np.ndarray | None = None) -> np.ndarray:
+        """Resets all boards, or only those selected by the boolean "mask", and returns the boards"""
+        idx = self._all if mask is None else np.flatnonzero(mask)
+        self.boards[idx] = 0
+        self.scores[idx] = 0
+        self.lines[idx] = 0
+        self._spawn(idx)
+        return self.boards
+
+    def piece_cells(self, idx=None, dx=0, dy=0, rotations=None) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (columns, rows) of the active pieces' cells, each of shape (len(idx), 4)"""
+        idx = self._all if idx is None else idx
+        rotations = self.rotations[idx] if rotations is None else rotations
+        cells = CELLS[self.piece_types[idx], rotations]
+        cols = cells[..., 0] + (self.x[idx] + dx)[:, None]
+        rows = cells[..., 1] + (self.y[idx] + dy)[:, None]
+        return cols, rows
+
+    def collides(self, idx: np.ndarray, cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Checks which of the pieces given by their cells leave the board or overlap placed blocks"""
+        outside = (cols < 0) | (cols >= self.width) | (rows >= self.height)
+        on_board = (rows >= 0) & ~outside
+        placed = self.boards[idx[:, None], np.clip(rows, 0, self.height - 1), np.clip(cols, 0, self.width - 1)] != 0
+        return (outside | (on_board & placed)).any(axis=1)
+
+    def step(self, actions) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Applies one action per board and a gravity step, returns (boards, rewards, dones)"""
+        actions = np.asarray(actions)
+        rewards = np.zeros(self.n, dtype=np.int64)
+
+        self._shift(actions == LEFT, -1, 0)
+        self._shift(actions == RIGHT, 1, 0)
+        self._shift(actions == DOWN, 0, 1)
+        self._rotate(actions == ROTATE)
+        self._hard_drop(actions == DROP)
+
+        falling = self._shift(np.ones(self.n, dtype=bool), 0, 1)
+        dones = self._lock(~falling, rewards)
+        if dones.any():
+            self.final_scores[dones] = self.scores[dones]
+            self.reset(dones)
+        return self.boards, rewards, dones
+
+    def _shift(self, mask: np.ndarray, dx: int, dy: int) -> np.ndarray:
+        """Moves the selected pieces if they fit, returns which of all the pieces moved"""
+        moved = np.zeros(self.n, dtype=bool)
+        idx = np.flatnonzero(mask)
+        if idx.size:
+            cols, rows = self.piece_cells(idx, dx, dy)
+            ok = idx[~self.collides(idx, cols, rows)]
+            self.x[ok] += dx
+            self.y[ok] += dy
+            moved[ok] = True
+        return moved
+
+    def _rotate(self, mask: np.ndarray):
+        """Rotates the selected pieces like the game does: the rotated piece is pushed back inside the walls and above
+        the floor, then the wall kicks are tried in order until one fits"""
+        idx = np.flatnonzero(mask)
+        if not idx.size:
+            return
+        rotations = (self.rotations[idx] + 1) % NR_ROTATIONS[self.piece_types[idx]]
+        cols, rows = self.piece_cells(idx, rotations=rotations)
+        dx = np.maximum(0, -cols.min(axis=1)) - np.maximum(0, cols.max(axis=1) - (self.width - 1))
+        dy = -np.maximum(0, rows.max(axis=1) - (self.height - 1))
+        for kick_x, kick_y in KICKS:
+            ok = ~self.collides(idx, cols + (dx + kick_x)[:, None], rows + (dy + kick_y)[:, None])
+            done = idx[ok]
+            self.rotations[done] = rotations[ok]
+            self.x[done] += dx[ok] + kick_x
+            self.y[done] += dy[ok] + kick_y
+            idx, rotations, cols, rows, dx, dy = (a[~ok] for a in (idx, rotations, cols, rows, dx, dy))
+            if not idx.size:
+                break
+
+    def _hard_drop(self, mask: np.ndarray):
+        idx = np.flatnonzero(mask)
+        dist = np.zeros(idx.size, dtype=np.int16)
+        falling = np.ones(idx.size, dtype=bool)
+        for _ in range(self.height + 4):
+            if not falling.any():
+                break
+            cols, rows = self.piece_cells(idx, dy=dist + 1)
+            falling &= ~self.collides(idx, cols, rows)
+            dist += falling
+        self.y[idx] += dist
+
+    def _lock(self, mask: np.ndarray, rewards: np.ndarray) -> np.ndarray:
+        """Locks the selected pieces, clears and scores complete lines and spawns new pieces. Returns the boards whose
+        game ended, either by locking a piece above the board or by having no room for the next one."""
+        dones = np.zeros(self.n, dtype=bool)
+        idx = np.flatnonzero(mask)
+        if not idx.size:
+            return dones
+        cols, rows = self.piece_cells(idx)
+        visible = rows >= 0
+        self.boards[np.broadcast_to(idx[:, None], rows.shape)[visible], rows[visible], cols[visible]] = \
+            np.broadcast_to(self.piece_types[idx, None], rows.shape)[visible]
+        dones[idx] = ~visible.all(axis=1)
+        rewards[idx] += PIECE_SCORE
+
+        boards = self.boards[idx]
+        full = (boards != 0).all(axis=2)
+        nr_lines = full.sum(axis=1)
+        if nr_lines.any():
+            # full rows go to the top, keeping the order of the others, and are then emptied
+            order = np.argsort(~full, axis=1, kind='stable')
+            boards = np.take_along_axis(boards, order[:, :, None], axis=1)
+            boards[np.arange(self.height)[None, :] < nr_lines[:, None]] = 0
+            self.boards[idx] = boards
+            rewards[idx] += LINE_SCORE * nr_lines
+            self.lines[idx] += nr_lines
+
+        self.scores += rewards
+        self._spawn(idx)
+        cols, rows = self.piece_cells(idx)
+        dones[idx] |= self.collides(idx, cols, rows)
+        return dones
+
+    def _spawn(self, idx: np.ndarray):
+        self.piece_types[idx] = self.rng.integers(1, len(PIECE_ROTATIONS) + 1, size=idx.size)
+        self.rotations[idx] = 0
+        self.x[idx] = self.spawn_dx
+        self.y[idx] = 0
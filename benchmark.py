@@ -0,0 +1,249 @@
+"""Times the hot paths of the game on seeded fixture boards and reports the time per operation.
+
+Usage: uv run benchmark.py [--only line_clear frame ...] [--json results.json] [--compare baseline.json]"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+# the rendering benchmarks draw to a window of the dummy video driver, so they also run without a display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+from tetris import (BLOCK_HEIGHT, BLOCK_POOL, BLOCK_WIDTH, BLOCKS_HORIZONTAL, BLOCKS_VERTICAL,
+                    MAX_BOARD_SIZE, PIECE_ROTATIONS, RESOLUTION, Game, GameState, HeadlessGame, PressedKeys,
+                    VirtualClock, draw_drop_preview, draw_game, draw_grid, get_bg, get_block, lock_piece,
+                    rotate_player_blocks)
+
+# name: (seed, board size, filled rows, well rows). The filled rows at the bottom of the board miss one random cell
+# each, except the bottom "well rows", which only miss the cell in the well column (WELL_COLUMN on the default board,
+# centered like the spawn position on others), so a vertical I piece there clears all of them.
+FIXTURES = {
+    'half': (1, (BLOCKS_HORIZONTAL, BLOCKS_VERTICAL), 10, 0),
+    'near_full': (2, (BLOCKS_HORIZONTAL, BLOCKS_VERTICAL), 18, 4),
+    'marathon': (3, MAX_BOARD_SIZE, MAX_BOARD_SIZE[1] // 2, 4),
+}
+WELL_COLUMN = 5
+RESULTS_VERSION = 1
+
+
+def fill_board(game: Game, fixture: str):
+    """Replaces the placed blocks of "game", which must have the fixture's board size, with those of the fixture, the
+    same for every run"""
+    seed, _, filled_rows, well_rows = FIXTURES[fixture]
+    board = game.board
+    rng = random.Random(seed)
+    board.clear()
+    for row in range(board.height - filled_rows, board.height):
+        hole = board.spawn_dx + WELL_COLUMN if row >= board.height - well_rows else rng.randrange(board.width)
+        color = tuple(rng.randint(90, 245) for _ in range(3))
+        board.lock([BLOCK_POOL.acquire(color, 1, (BLOCK_WIDTH * col, BLOCK_HEIGHT * row))
+                    for col in range(board.width) if col != hole])
+
+
+def set_piece(game: Game, block_type: int, rotation=0, dy=0):
+    """Replaces the falling piece of "game" with a piece of "block_type" in rotation state "rotation", moved down by
+    "dy" rows from its spawn position"""
+    BLOCK_POOL.release(*game.player_blocks)
+    blocks = get_block(block_type, (200, 120, 60))
+    for block, (col, row) in zip(blocks, PIECE_ROTATIONS[block_type][rotation]):
+        block.rect.topleft = (BLOCK_WIDTH * (col + game.board.spawn_dx), BLOCK_HEIGHT * (row + dy))
+        block.rotation = rotation
+    game.player_blocks.add(*blocks)
+    game.all_sprites.add(*blocks)
+
+
+def fixture_game(fixture: str, seed=0) -> HeadlessGame:
+    headless_game = HeadlessGame(seed=seed, board_size=FIXTURES[fixture][1])
+    fill_board(headless_game.game, fixture)
+    return headless_game
+
+
+def bench_line_clear(fixture: str):
+    def bench(number: int) -> float:
+        """Locks a vertical I piece into the well of the fixture, clearing 4 lines below all the other filled rows"""
+        headless_game = fixture_game(fixture)
+        game, game_state = headless_game.game, headless_game.game_state
+        elapsed = 0
+        for _ in range(number):
+            fill_board(game, fixture)
+            set_piece(game, 2, rotation=1, dy=game.board.height - 2)
+            start = time.perf_counter()
+            lock_piece(game, game_state)
+            elapsed += time.perf_counter() - start
+        return elapsed
+    return bench
+
+
+def bench_rotate(block_type: int):
+    def bench(number: int) -> float:
+        """Rotates a piece of one type through all its states, in the open rows above the half full board"""
+        headless_game = fixture_game('half')
+        game = headless_game.game
+        set_piece(game, block_type, dy=4)
+        player_blocks, board = game.player_blocks, game.board
+        start = time.perf_counter()
+        for _ in range(number):
+            rotate_player_blocks(player_blocks, board)
+        return time.perf_counter() - start
+    return bench
+
+
+def bench_sideways(number: int) -> float:
+    """Moves a T piece left and right with BlocksUpdater, every update a new key press checking the move against the
+    board"""
+    headless_game = fixture_game('half')
+    game, clock = headless_game.game, headless_game.clock
+    set_piece(game, 6, dy=4)
+    updater, player_blocks, board = game.blocks_updater, game.player_blocks, game.board
+    keys = [PressedKeys(pressed=[pygame.K_LEFT])] * 4 + [PressedKeys(pressed=[pygame.K_RIGHT])] * 4
+    elapsed = 0
+    for i in range(number):
+        clock.advance(70)
+        # no gravity, the piece stays in the same rows
+        updater.last_auto_down_movement_time = clock.get_ticks()
+        start = time.perf_counter()
+        updater.update_player_blocks(keys[i % len(keys)], player_blocks, board)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def bench_drop_preview(number: int) -> float:
+    headless_game = fixture_game('half')
+    game = headless_game.game
+    set_piece(game, 4, dy=2)
+    screen, player_blocks, board, viewport = game.screen, game.player_blocks, game.board, game.viewport
+    start = time.perf_counter()
+    for _ in range(number):
+        draw_drop_preview(screen, player_blocks, board, viewport)
+    return time.perf_counter() - start
+
+
+def bench_draw_grid(number: int) -> float:
+    surface = pygame.Surface(RESOLUTION)
+    start = time.perf_counter()
+    for _ in range(number):
+        draw_grid(surface)
+    return time.perf_counter() - start
+
+
+def bench_frame(fixture: str, resolution=RESOLUTION):
+    def bench(number: int) -> float:
+        """Draws and presents frames of the fixture in a window of "resolution" of the video driver, with the piece
+        just above the filled rows, redrawing only the changed regions like the game does"""
+        game = Game(resolution, clock=VirtualClock(), board_size=FIXTURES[fixture][1])
+        game_state = GameState()
+        fill_board(game, fixture)
+        set_piece(game, 6, dy=game.board.height - FIXTURES[fixture][2] - 3)
+        bg = get_bg()
+        start = time.perf_counter()
+        for _ in range(number):
+            draw_game(bg, game, game_state)
+            pygame.display.flip()
+            game.dirty_rects.take()
+        elapsed = time.perf_counter() - start
+        pygame.display.quit()
+        pygame.display.init()
+        return elapsed
+    return bench
+
+
+def bench_headless_game(number: int) -> float:
+    """Plays whole headless games that drop every piece where it spawns, one operation is one game"""
+    start = time.perf_counter()
+    for seed in range(number):
+        headless_game = HeadlessGame(seed=seed)
+        while not headless_game.game_state.dead:
+            headless_game.step({pygame.K_d})
+    return time.perf_counter() - start
+
+
+# name: (benchmark, operations per round)
+BENCHMARKS = {
+    'line_clear': (bench_line_clear('near_full'), 500),
+    'line_clear_marathon': (bench_line_clear('marathon'), 5),
+    **{f'rotate_{block_type}': (bench_rotate(block_type), 5000) for block_type in sorted(PIECE_ROTATIONS)},
+    'sideways': (bench_sideways, 5000),
+    'drop_preview': (bench_drop_preview, 5000),
+    'draw_grid': (bench_draw_grid, 50),
+    'frame': (bench_frame('near_full'), 200),
+    'frame_marathon': (bench_frame('marathon'), 200),
+    'frame_4k': (bench_frame('near_full', (3840, 2160)), 200),
+    'headless_game': (bench_headless_game, 20),
+}
+
+
+def run_benchmarks(names: list[str], repeat=5, scale=1.0) -> dict:
+    """Runs every benchmark "repeat" times and returns the best and median time per operation of each"""
+    results = {}
+    for name in names:
+        bench, number = BENCHMARKS[name]
+        number = max(1, int(number * scale))
+        rounds = [bench(number) / number for _ in range(repeat)]
+        results[name] = {
+            'number': number,
+            'repeat': repeat,
+            'best_us': min(rounds) * 1e6,
+            'median_us': statistics.median(rounds) * 1e6,
+            'ops_per_s': 1 / statistics.median(rounds),
+        }
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'sdl': '.'.join(map(str, pygame.get_sdl_version())),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def format_results(results: dict, baseline: dict | None = None) -> str:
+    header = f'{"benchmark":<20}{"median us":>12}{"best us":>12}{"ops/s":>12}'
+    lines = [header + f'{"vs base":>10}' if baseline else header]
+    for name, result in results.items():
+        line = f'{name:<20}{result["median_us"]:>12.2f}{result["best_us"]:>12.2f}{result["ops_per_s"]:>12.0f}'
+        if baseline and name in baseline:
+            line += f'{result["median_us"] / baseline[name]["median_us"]:>9.2f}x'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), metavar='NAME',
+                        help=f'benchmarks to run: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per benchmark, the median round is reported')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the operations per round')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', metavar='FILE', help='results file of an earlier run to compare the medians with')
+    args = parser.parse_args()
+
+    pygame.init()
+    results = run_benchmarks(args.only, args.repeat, args.scale)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print(format_results(results, baseline))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'environment': environment(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
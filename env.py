@@ -0,0 +1,118 @@
+"""Gym-style environment playing single games with the full game rules of tetris.py, with board or pixel observations.
+
+Needs NumPy, install it with `uv sync --extra numpy`."""
+import random
+
+import numpy as np
+import pygame
+
+from batch_env import DOWN, DROP, LEFT, NOOP, NR_ACTIONS, RIGHT, ROTATE
+from tetris import BLOCKS_HORIZONTAL, BLOCKS_VERTICAL, RESOLUTION, HeadlessGame, get_bg
+
+ACTION_KEYS = {
+    NOOP: (),
+    LEFT: (pygame.K_LEFT,),
+    RIGHT: (pygame.K_RIGHT,),
+    ROTATE: (pygame.K_SPACE,),
+    DOWN: (pygame.K_DOWN,),
+    DROP: (pygame.K_d,),
+}
+# cells of the grid observation
+EMPTY = 0
+PLACED = 1
+PIECE = 2
+
+
+def buffer_surface(size: tuple[int, int]) -> tuple[pygame.Surface, np.ndarray]:
+    """Returns a surface of "size" drawing into the memory of a (height, width, 4) RGBX array, and the array.
+
+    Unlike pygame.surfarray.pixels3d() views, which lock the surface as long as they exist so nothing can be blitted
+    on it, the array and the surface share their memory for good."""
+    pixels = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    return pygame.image.frombuffer(pixels, size, 'RGBX'), pixels
+
+
+class TetrisEnv:
+    """Plays one game at a time, one step of the game rules per frame.
+
+    Every step applies an action (NOOP, LEFT, RIGHT, ROTATE, DOWN or DROP, like batch_env) as a key press and runs
+    "frame_skip" frames, the reward is the score gained. With observation="grid" observations are (height, width)
+    arrays of EMPTY, PLACED and PIECE cells, with "pixels" (height, width, 3) RGB arrays of the rendered frame, scaled
+    to "pixel_size" if given.
+
+    Observations are views of buffers the environment reuses, no copy is made per step: the game draws straight into
+    the memory of the pixel observation, the next step overwrites it. Copy an observation to keep it."""
+
+    def __init__(self, observation='grid', seed=None, board_size=(BLOCKS_HORIZONTAL, BLOCKS_VERTICAL),
+                 pixel_size: tuple[int, int] | None = None, frame_skip=1, max_steps: int | None = None):
+        if observation not in ('grid', 'pixels'):
+            raise ValueError(f"unknown observation {observation!r}, use 'grid' or 'pixels'")
+        self.observation = observation
+        self.board_size = board_size
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+        self.n_actions = NR_ACTIONS
+        # the games are seeded from this, so an environment created with a seed plays the same games
+        self.seeds = random.Random(seed)
+        self.grid = np.zeros((board_size[1], board_size[0]), dtype=np.uint8)
+        self.screen, self.screen_pixels = buffer_surface(RESOLUTION)
+        self.pixel_surface, self.scaled_pixels = self.screen, self.screen_pixels
+        if pixel_size is not None and tuple(pixel_size) != RESOLUTION:
+            self.pixel_surface, self.scaled_pixels = buffer_surface(pixel_size)
+        self.bg = None
+        self.headless_game: HeadlessGame | None = None
+        self.steps = 0
+
+    def reset(self, seed=None) -> tuple[np.ndarray, dict]:
+        """Starts a new game, with "seed" or the next seed of the environment, and returns (observation, info)"""
+        if seed is None:
+            seed = self.seeds.randrange(2 ** 32)
+        self.headless_game = HeadlessGame(seed=seed, board_size=self.board_size, screen=self.screen)
+        self.steps = 0
+        return self._observe(), self._info()
+
+    def step(self, action: int) -> tuple[np.ndarray, int, bool, bool, dict]:
+        """Returns (observation, reward, terminated, truncated, info), terminated when the game is over and truncated
+        after "max_steps" steps"""
+        game_state = self.headless_game.game_state
+        score = game_state.score
+        keys = ACTION_KEYS[int(action)]
+        # every action is a new key press, so repeated actions move every step instead of waiting for the key repeat
+        self.headless_game.step(keys, pressed=keys)
+        for _ in range(self.frame_skip - 1):
+            self.headless_game.step()
+        self.steps += 1
+        truncated = self.max_steps is not None and self.steps >= self.max_steps
+        return self._observe(), game_state.score - score, game_state.dead, truncated, self._info()
+
+    def render(self) -> np.ndarray:
+        """Draws the current frame and returns it as a (height, width, 3) RGB view, at "pixel_size" if given"""
+        if self.bg is None:
+            pygame.font.init()
+            self.bg = get_bg()
+        self.headless_game.render(self.bg)
+        if self.pixel_surface is not self.screen:
+            pygame.transform.smoothscale(self.screen, self.pixel_surface.get_size(), self.pixel_surface)
+        return self.scaled_pixels[..., :3]
+
+    def close(self):
+        self.headless_game = None
+
+    def _observe(self) -> np.ndarray:
+        if self.observation == 'pixels':
+            return self.render()
+        grid = self.grid
+        grid.fill(EMPTY)
+        board = self.headless_game.game.board
+        for row, (cells, count) in enumerate(zip(board.cells, board.row_counts)):
+            if count:
+                grid[row, [col for col, cell in enumerate(cells) if cell is not None]] = PLACED
+        for block in self.headless_game.game.player_blocks:
+            col, row = board.cell_of(block.rect)
+            if 0 <= row < board.height and 0 <= col < board.width:
+                grid[row, col] = PIECE
+        return grid
+
+    def _info(self) -> dict:
+        game_state = self.headless_game.game_state
+        return {'score': game_state.score, 'lines': game_state.lines_cleared, 'pieces': game_state.pieces_placed}
@@ -0,0 +1,123 @@
+"""Plays back games recorded with `tetris.py --record` headless and at full speed.
+
+Usage: uv run replay.py FILE [--piece N] [--screenshot out.png]"""
+import argparse
+import time
+
+import pygame
+
+from tetris import GAME_KEYS, REPLAY_MAGIC, REPLAY_RESTART, REPLAY_VERSION, HeadlessGame, read_varint, unzigzag
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayPlayer:
+    """Replays a recorded stream in a HeadlessGame. The spawned pieces are checked against the recorded ones, so a replay
+    that no longer matches the game rules fails with a ReplayError instead of silently diverging."""
+
+    def __init__(self, data: bytes):
+        if data[:len(REPLAY_MAGIC)] != REPLAY_MAGIC:
+            raise ReplayError("not a replay file")
+        version = data[len(REPLAY_MAGIC)]
+        if version < REPLAY_VERSION:
+            # the input rules changed in version 3, older replays would diverge
+            raise ReplayError(f"replay version {version} was recorded with older game rules")
+        if version > REPLAY_VERSION:
+            raise ReplayError(f"unsupported replay version {version}")
+        self.data = data
+        seed, pos = read_varint(data, len(REPLAY_MAGIC) + 1)
+        self.seed = unzigzag(seed)
+        header = []
+        for _ in range(4):
+            value, pos = read_varint(data, pos)
+            header.append(value)
+        width, height, self.das_ms, self.arr_ms = header
+        self.board_size = width, height
+        self.start = pos
+        self.headless_game = None
+        self.rewind()
+
+    @classmethod
+    def load(cls, path) -> 'ReplayPlayer':
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def rewind(self):
+        self.headless_game = HeadlessGame(seed=self.seed, board_size=self.board_size, das_ms=self.das_ms,
+                                          arr_ms=self.arr_ms)
+        self.pos = self.start
+        self.frame_ms = 0
+        self.frames = 0
+        # pieces spawned since the start, the first piece of the recording is piece 0
+        self.pieces = 0
+
+    def play(self, until_piece=None) -> HeadlessGame:
+        """Plays to the end, or until piece "until_piece" was spawned, and returns the game"""
+        if until_piece is not None and until_piece < self.pieces:
+            self.rewind()
+        data = self.data
+        while self.pos < len(data) and (until_piece is None or self.pieces < until_piece):
+            run_length, self.pos = read_varint(data, self.pos)
+            if run_length == 0:
+                self._marker(data[self.pos])
+                self.pos += 1
+                continue
+            keys, self.pos = read_varint(data, self.pos)
+            frame_ms, self.pos = read_varint(data, self.pos)
+            self.frame_ms += unzigzag(frame_ms)
+            held = {key for bit, key in enumerate(GAME_KEYS) if keys & 1 << bit}
+            pressed = {key for bit, key in enumerate(GAME_KEYS) if keys & 1 << bit + len(GAME_KEYS)}
+            for _ in range(run_length):
+                self.headless_game.step(held, ms=self.frame_ms, pressed=pressed)
+            self.frames += run_length
+        return self.headless_game
+
+    def _marker(self, code: int):
+        if code == REPLAY_RESTART:
+            self.headless_game.restart()
+            return
+        block_type = next(iter(self.headless_game.game.player_blocks)).block_type
+        if block_type != code:
+            raise ReplayError(f"replay diverged at frame {self.frames}: "
+                              f"piece {self.pieces + 1} is of type {block_type} instead of {code}")
+        self.pieces += 1
+
+
+def board_text(headless_game: HeadlessGame) -> str:
+    """Draws the board as text, placed blocks as "#" and the falling piece as "@" """
+    board = headless_game.game.board
+    rows = [['#' if cell else '.' for cell in row] for row in board.cells]
+    for block in headless_game.game.player_blocks:
+        col, row = board.cell_of(block.rect)
+        if 0 <= row < board.height and 0 <= col < board.width:
+            rows[row][col] = '@'
+    return '\n'.join(''.join(row) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file')
+    parser.add_argument('--piece', type=int, help="stop when the given piece (counted from 0) has spawned")
+    parser.add_argument('--screenshot', help="save the last frame as an image")
+    args = parser.parse_args()
+
+    player = ReplayPlayer.load(args.file)
+    start = time.perf_counter()
+    headless_game = player.play(args.piece)
+    elapsed = time.perf_counter() - start
+
+    game_state = headless_game.game_state
+    print(board_text(headless_game))
+    print(f"piece {player.pieces}, frame {player.frames}, score {game_state.score}, record {game_state.record}, "
+          f"lines {game_state.lines_cleared}{', game over' if game_state.dead else ''}")
+    print(f"replayed in {elapsed:.3f}s ({len(player.data)} bytes)")
+
+    if args.screenshot:
+        pygame.font.init()
+        pygame.image.save(headless_game.render(), args.screenshot)
+
+
+if __name__ == '__main__':
+    main()
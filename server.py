@@ -0,0 +1,382 @@
+"""Runs the game rules of many sessions in one asyncio event loop and streams compact state deltas to TCP clients.
+
+Usage: uv run server.py [--host 127.0.0.1] [--port 7777]
+       uv run server.py --load-test 300 [--duration 10] [--in-process]"""
+import argparse
+import asyncio
+import random
+import statistics
+import struct
+import time
+
+from tetris import (GAME_KEYS, MAX_CATCH_UP_MS, STEP_MS, HeadlessGame, piece_position, read_varint, unzigzag,
+                    write_varint, zigzag)
+
+PORT = 7777
+# a client whose unsent data exceeds this gets no deltas until it caught up, the next one then has all the changes
+MAX_WRITE_BUFFER = 64 * 1024
+STATS_INTERVAL = 10
+
+# message types, the first byte of every message. Messages are sent with their length as 2 bytes in front.
+HELLO = ord('H')
+DELTA = ord('D')
+KEYS = ord('K')
+RESTART = ord('R')
+# sections of a delta, in this order
+CELLS = 1
+PIECE = 2
+SCORE = 4
+DEAD = 8
+
+
+def pack_message(payload: bytes) -> bytes:
+    return struct.pack('>H', len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> bytes:
+    size, = struct.unpack('>H', await reader.readexactly(2))
+    return await reader.readexactly(size)
+
+
+def keys_to_bits(keys) -> int:
+    return sum(1 << bit for bit, key in enumerate(GAME_KEYS) if key in keys)
+
+
+def bits_to_keys(bits: int) -> frozenset[int]:
+    return frozenset(key for bit, key in enumerate(GAME_KEYS) if bits & 1 << bit)
+
+
+class Session:
+    """One client's game and the state it was last sent. Deltas are always taken against what was sent, so a delta
+    that is skipped is included in the next one."""
+
+    def __init__(self, seed: int, writer: asyncio.StreamWriter | None = None):
+        self.seed = seed
+        self.writer = writer
+        self.headless_game = HeadlessGame(seed=seed, resolution=(1, 1))
+        # keys the client holds, and those it released or released and pressed again since the last step, so a tap
+        # between two steps isn't lost
+        self.keys: frozenset[int] = frozenset()
+        self.released: set[int] = set()
+        self.pressed: set[int] = set()
+        board = self.headless_game.game.board
+        self.sent_cells = [[None] * board.width for _ in range(board.height)]
+        # the board only changes when a piece is locked or the game restarts, both spawn a new piece
+        self.compared_pieces = -1
+        self.sent_piece = None
+        self.sent_score = None
+        self.sent_dead = None
+
+    def hello(self) -> bytes:
+        board = self.headless_game.game.board
+        message = bytearray([HELLO])
+        write_varint(message, zigzag(self.seed))
+        write_varint(message, board.width)
+        write_varint(message, board.height)
+        return bytes(message)
+
+    def set_keys(self, keys: frozenset[int]):
+        """Takes the keys the client holds now, the changes are latched until the next step"""
+        self.pressed.update(keys & self.released)
+        self.released.update(self.keys - keys)
+        self.keys = keys
+
+    def step(self):
+        self.headless_game.step(self.keys | self.released, pressed=self.pressed)
+        self.released.clear()
+        self.pressed.clear()
+
+    def delta(self, frame: int) -> bytes | None:
+        """Returns the changes since the last delta, or None if nothing changed.
+
+        A delta is DELTA, the frame number and a byte with the sections that follow. CELLS: the number of changed
+        cells, then for each (row * width + column) * 2 + filled and the color if filled. PIECE: the number of the
+        piece, its type, rotation state, column and row offset from its PIECE_ROTATIONS cells and its color. SCORE: the
+        score and the cleared lines. DEAD: 1 if the game is over."""
+        game, game_state = self.headless_game.game, self.headless_game.game_state
+        message = bytearray([DELTA])
+        write_varint(message, frame)
+        sections_pos = len(message)
+        message.append(0)
+        sections = 0
+
+        if game.pieces_spawned != self.compared_pieces:
+            self.compared_pieces = game.pieces_spawned
+            changes = []
+            width = game.board.width
+            for row, (cells, sent) in enumerate(zip(game.board.cells, self.sent_cells)):
+                if cells != sent:
+                    changes.extend((row * width + col, cell)
+                                   for col, (cell, sent_cell) in enumerate(zip(cells, sent)) if cell != sent_cell)
+                    self.sent_cells[row] = cells.copy()
+            if changes:
+                sections |= CELLS
+                write_varint(message, len(changes))
+                for index, color in changes:
+                    write_varint(message, index * 2 + (color is not None))
+                    if color is not None:
+                        message.extend(color)
+
+        position = piece_position(game.player_blocks, game.board)
+        if position is not None:
+            piece = game.pieces_spawned, *position, next(iter(game.player_blocks)).color
+            if piece != self.sent_piece:
+                self.sent_piece = piece
+                sections |= PIECE
+                number, block_type, rotation, dx, dy, color = piece
+                write_varint(message, number)
+                message.append(block_type)
+                message.append(rotation)
+                write_varint(message, zigzag(dx))
+                write_varint(message, zigzag(dy))
+                message.extend(color)
+
+        score = game_state.score, game_state.lines_cleared
+        if score != self.sent_score:
+            self.sent_score = score
+            sections |= SCORE
+            write_varint(message, score[0])
+            write_varint(message, score[1])
+
+        if game_state.dead != self.sent_dead:
+            self.sent_dead = game_state.dead
+            sections |= DEAD
+            message.append(game_state.dead)
+
+        if not sections:
+            return None
+        message[sections_pos] = sections
+        return bytes(message)
+
+
+class Server:
+    """Accepts TCP clients, each playing its own session, and steps all the sessions every STEP_MS. Clients send their
+    held keys as KEYS and a byte with the GAME_KEYS bits whenever they change, and RESTART after a game over."""
+
+    def __init__(self, first_seed: int | None = None):
+        self.sessions: dict[int, Session] = {}
+        self.next_seed = first_seed if first_seed is not None else random.randrange(2 ** 32)
+        self.frame = 0
+        # the game rules can be paused, for comparing the clients' state with the sessions
+        self.stepping = True
+        self.tick_times: list[float] = []
+        self.late_ticks = 0
+        self.skipped_deltas = 0
+        self.sent_bytes = 0
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(self.next_seed, writer)
+        self.next_seed += 1
+        self.sessions[session.seed] = session
+        writer.write(pack_message(session.hello()))
+        try:
+            while True:
+                message = await read_message(reader)
+                # malformed messages and unknown types are ignored
+                if len(message) == 2 and message[0] == KEYS:
+                    session.set_keys(bits_to_keys(message[1]))
+                elif len(message) == 1 and message[0] == RESTART and session.headless_game.game_state.dead:
+                    session.headless_game.restart()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.sessions[session.seed]
+            writer.close()
+
+    def tick(self):
+        self.frame += 1
+        sessions = list(self.sessions.values())
+        if self.stepping:
+            for session in sessions:
+                session.step()
+        for session in sessions:
+            if session.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                self.skipped_deltas += 1
+                continue
+            if (delta := session.delta(self.frame)) is not None:
+                message = pack_message(delta)
+                session.writer.write(message)
+                self.sent_bytes += len(message)
+
+    async def run(self):
+        """Ticks every STEP_MS, catching up after late ticks but at most MAX_CATCH_UP_MS"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            start = time.perf_counter()
+            self.tick()
+            self.tick_times.append(time.perf_counter() - start)
+            next_tick += STEP_MS / 1000
+            if loop.time() - next_tick > MAX_CATCH_UP_MS / 1000:
+                self.late_ticks += 1
+                next_tick = loop.time()
+
+    def stats(self) -> dict:
+        """Returns the tick statistics since the last call"""
+        times, self.tick_times = self.tick_times, []
+        times.sort()
+        return {
+            'sessions': len(self.sessions),
+            'ticks': len(times),
+            'tick_mean_ms': statistics.fmean(times) * 1000 if times else 0.0,
+            'tick_p99_ms': times[len(times) * 99 // 100] * 1000 if times else 0.0,
+            'tick_budget_ms': STEP_MS,
+            'late_ticks': self.late_ticks,
+            'skipped_deltas': self.skipped_deltas,
+        }
+
+
+class ClientState:
+    """The state of one session as rebuilt by a client from the hello and the deltas"""
+
+    def __init__(self, hello: bytes):
+        seed, pos = read_varint(hello, 1)
+        self.seed = unzigzag(seed)
+        self.width, pos = read_varint(hello, pos)
+        self.height, pos = read_varint(hello, pos)
+        self.cells: list[list[tuple[int, int, int] | None]] = [[None] * self.width for _ in range(self.height)]
+        self.frame = 0
+        self.piece = None
+        self.score = 0
+        self.lines = 0
+        self.dead = False
+
+    def apply(self, delta: bytes):
+        self.frame, pos = read_varint(delta, 1)
+        sections = delta[pos]
+        pos += 1
+        if sections & CELLS:
+            count, pos = read_varint(delta, pos)
+            for _ in range(count):
+                value, pos = read_varint(delta, pos)
+                row, col = divmod(value // 2, self.width)
+                if value & 1:
+                    self.cells[row][col] = tuple(delta[pos:pos + 3])
+                    pos += 3
+                else:
+                    self.cells[row][col] = None
+        if sections & PIECE:
+            number, pos = read_varint(delta, pos)
+            block_type, rotation = delta[pos], delta[pos + 1]
+            dx, pos = read_varint(delta, pos + 2)
+            dy, pos = read_varint(delta, pos)
+            self.piece = number, block_type, rotation, unzigzag(dx), unzigzag(dy), tuple(delta[pos:pos + 3])
+            pos += 3
+        if sections & SCORE:
+            self.score, pos = read_varint(delta, pos)
+            self.lines, pos = read_varint(delta, pos)
+        if sections & DEAD:
+            self.dead = bool(delta[pos])
+
+
+async def load_test_client(host: str, port: int, stop: asyncio.Event, seed: int) -> tuple[ClientState, dict]:
+    """Plays one session with random keys until "stop" is set and returns its state and traffic"""
+    reader, writer = await asyncio.open_connection(host, port)
+    state = ClientState(await read_message(reader))
+    traffic = {'messages': 0, 'bytes': 0}
+    rng = random.Random(seed)
+
+    async def receive():
+        while True:
+            delta = await read_message(reader)
+            state.apply(delta)
+            traffic['messages'] += 1
+            traffic['bytes'] += len(delta) + 2
+
+    receiver = asyncio.create_task(receive())
+    while not stop.is_set():
+        if state.dead:
+            writer.write(pack_message(bytes([RESTART])))
+        keys = {rng.choice(GAME_KEYS)} if rng.random() < 0.5 else set()
+        writer.write(pack_message(bytes([KEYS, keys_to_bits(keys)])))
+        try:
+            await asyncio.wait_for(stop.wait(), rng.uniform(0.05, 0.3))
+        except TimeoutError:
+            pass
+    writer.write(pack_message(bytes([KEYS, 0])))
+    # the last deltas are still on their way
+    await asyncio.sleep(0.5)
+    receiver.cancel()
+    writer.close()
+    return state, traffic
+
+
+async def load_test(sessions: int, duration: float, host: str, port: int, in_process: bool) -> dict:
+    """Connects "sessions" clients pressing random keys for "duration" seconds and returns the traffic they saw. With
+    "in_process" the server runs in the same event loop, then its tick times are reported and the clients' state is
+    checked against the sessions."""
+    server = ticker = None
+    if in_process:
+        server = Server(first_seed=0)
+        listener = await asyncio.start_server(server.handle_client, host, 0, backlog=sessions)
+        port = listener.sockets[0].getsockname()[1]
+        ticker = asyncio.create_task(server.run())
+    stop = asyncio.Event()
+    clients = [asyncio.create_task(load_test_client(host, port, stop, seed)) for seed in range(sessions)]
+    await asyncio.sleep(duration)
+    if server:
+        server_stats = server.stats()
+        # let the clients receive the final state, the sessions are gone once the clients disconnect
+        server.stepping = False
+        sessions_by_seed = dict(server.sessions)
+    stop.set()
+    results = await asyncio.gather(*clients)
+
+    messages = sum(traffic['messages'] for _, traffic in results)
+    sent = sum(traffic['bytes'] for _, traffic in results)
+    report = {
+        'sessions': sessions,
+        'duration_s': duration,
+        'deltas_per_session_per_s': messages / sessions / duration,
+        'bytes_per_session_per_s': sent / sessions / duration,
+        'mean_delta_bytes': sent / messages if messages else 0.0,
+    }
+    if server:
+        matching = sum(state.cells == sessions_by_seed[state.seed].headless_game.game.board.cells
+                       and state.score == sessions_by_seed[state.seed].headless_game.game_state.score
+                       for state, _ in results)
+        report.update(server_stats)
+        report['matching_clients'] = matching
+        ticker.cancel()
+        listener.close()
+    return report
+
+
+async def serve(host: str, port: int, seed: int | None):
+    server = Server(seed)
+    listener = await asyncio.start_server(server.handle_client, host, port)
+    print(f'listening on {host}:{port}')
+    ticker = asyncio.create_task(server.run())
+    async with listener:
+        while not ticker.done():
+            await asyncio.sleep(STATS_INTERVAL)
+            stats = server.stats()
+            print(f"{stats['sessions']} sessions, {stats['ticks']} ticks, tick mean {stats['tick_mean_ms']:.2f} ms, "
+                  f"p99 {stats['tick_p99_ms']:.2f} ms (budget {STEP_MS} ms), {stats['late_ticks']} late")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--seed', type=int, help='seed of the first session, the next ones count up from it')
+    parser.add_argument('--load-test', type=int, metavar='N', help='connect N clients pressing random keys instead')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the load test runs')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the load test against a server in the same process, checking the clients\' state')
+    args = parser.parse_args()
+
+    try:
+        if args.load_test:
+            report = asyncio.run(load_test(args.load_test, args.duration, args.host, args.port, args.in_process))
+            for key, value in report.items():
+                print(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}')
+        else:
+            asyncio.run(serve(args.host, args.port, args.seed))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Plays headless games for a long time and checks that memory use and frame times stay flat.
+
+Usage: uv run soak.py [--pieces 1000000] [--policy search] [--render] [--tracemalloc] [--out soak.jsonl]"""
+import argparse
+import gc
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+import pygame
+
+from tetris import HeadlessGame, get_bg
+from tournament import POLICIES
+
+TOP_ALLOCATORS = 10
+# samples at the start and the end of the run whose medians are compared, single samples are too noisy
+COMPARED_SAMPLES = 3
+
+
+def rss_bytes() -> int | None:
+    """Returns the resident set size of the process, its peak where the current one isn't available and None where
+    neither is (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Soak:
+    """Plays games of one policy back to back in a HeadlessGame, restarting after every game over like the game does,
+    and samples the memory use, the garbage collector and the frame times every "interval" seconds"""
+
+    def __init__(self, policy_name='search', seed=0, render=False, trace=False):
+        self.headless_game = HeadlessGame(seed=seed)
+        self.policy = POLICIES[policy_name](seed)
+        self.bg = None
+        if render:
+            pygame.font.init()
+            self.bg = get_bg()
+        self.trace = trace
+        if trace:
+            tracemalloc.start()
+        self.baseline_trace = None
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.games = 1
+        self.frame_times: list[float] = []
+
+    @property
+    def pieces(self) -> int:
+        return self.headless_game.game.pieces_spawned
+
+    def play(self, seconds: float, max_pieces: int):
+        """Plays for "seconds" or until "max_pieces" pieces were spawned"""
+        headless_game, game_state, frame_times = self.headless_game, self.headless_game.game_state, self.frame_times
+        end = time.perf_counter() + seconds
+        while self.pieces < max_pieces:
+            start = time.perf_counter()
+            headless_game.step(self.policy(headless_game))
+            if self.bg:
+                headless_game.render(self.bg)
+            now = time.perf_counter()
+            frame_times.append(now - start)
+            self.frames += 1
+            if game_state.dead:
+                headless_game.restart()
+                self.games += 1
+            if now >= end:
+                break
+
+    def sample(self) -> dict:
+        """Returns the current measurements, the frame times are those since the last sample"""
+        times = sorted(self.frame_times)
+        self.frame_times.clear()
+        sample = {
+            'time_s': time.perf_counter() - self.start,
+            'pieces': self.pieces,
+            'frames': self.frames,
+            'games': self.games,
+            'rss_mb': rss / 2 ** 20 if (rss := rss_bytes()) is not None else None,
+            'gc_counts': gc.get_count(),
+            'gc_collections': [generation['collections'] for generation in gc.get_stats()],
+        }
+        # counted after a full collection, before it the count depends on when the collector last ran
+        gc.collect()
+        sample.update({
+            'objects': len(gc.get_objects()),
+            'uncollectable': len(gc.garbage),
+            'frame_p50_ms': times[len(times) // 2] * 1000 if times else 0.0,
+            'frame_p99_ms': times[len(times) * 99 // 100] * 1000 if times else 0.0,
+        })
+        if self.trace:
+            # the harness's own allocations (the frame times) aren't the game's
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                                   tracemalloc.Filter(False, tracemalloc.__file__)])
+            sample['traced_mb'] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+            if self.baseline_trace is None:
+                self.baseline_trace = snapshot
+            sample['top_growth'] = [f'{stat.traceback}: {stat.size_diff / 1024:+.1f} KiB'
+                                    for stat in snapshot.compare_to(self.baseline_trace, 'lineno')[:TOP_ALLOCATORS]]
+        return sample
+
+
+def check(samples: list[dict], max_rss_growth_mb: float, max_objects_growth: int,
+          max_frame_growth: float) -> list[str]:
+    """Returns a message for every threshold the growth from the first to the last COMPARED_SAMPLES samples exceeds"""
+    size = min(COMPARED_SAMPLES, len(samples) // 2)
+
+    def growth(key: str) -> tuple[float, float]:
+        return (statistics.median(sample[key] for sample in samples[:size]),
+                statistics.median(sample[key] for sample in samples[-size:]))
+
+    failures = []
+    if samples[0]['rss_mb'] is not None:
+        first, last = growth('rss_mb')
+        if last - first > max_rss_growth_mb:
+            failures.append(f'RSS grew by {last - first:.1f} MB (limit {max_rss_growth_mb} MB)')
+    first, last = growth('objects')
+    if last - first > max_objects_growth:
+        failures.append(f'{last - first:.0f} more objects tracked by the garbage collector (limit {max_objects_growth})')
+    if samples[-1]['uncollectable']:
+        failures.append(f"{samples[-1]['uncollectable']} uncollectable objects in gc.garbage")
+    first, last = growth('frame_p99_ms')
+    if first and last / first > max_frame_growth:
+        failures.append(f'p99 frame time grew {last / first:.2f}x (limit {max_frame_growth}x)')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pieces', type=int, default=1_000_000, help='pieces to play, across all games')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds even if not all pieces were played')
+    parser.add_argument('--policy', choices=list(POLICIES), default='search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--render', action='store_true', help='also draw every frame off-screen, like the game does')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help=f'trace allocations and report the {TOP_ALLOCATORS} lines whose memory grew the most '
+                             f'(slows the game down)')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between samples')
+    parser.add_argument('--warmup', type=int, default=10_000,
+                        help='pieces played before the baseline sample the growth is measured from')
+    parser.add_argument('--out', help='write the samples to this file, one JSON object per line')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=50)
+    parser.add_argument('--max-objects-growth', type=int, default=10_000)
+    parser.add_argument('--max-frame-growth', type=float, default=1.5, help='limit of the p99 frame time ratio')
+    args = parser.parse_args()
+
+    soak = Soak(args.policy, args.seed, args.render, args.tracemalloc)
+    end = soak.start + args.duration if args.duration else float('inf')
+    out = open(args.out, 'w') if args.out else None
+    # the samples after the warmup
+    samples = []
+    try:
+        while soak.pieces < args.pieces and time.perf_counter() < end:
+            soak.play(min(args.interval, end - time.perf_counter()), args.pieces)
+            # the warmup fills the caches and pools, the baseline is taken after it
+            if not samples and soak.pieces < min(args.warmup, args.pieces):
+                soak.frame_times.clear()
+                continue
+            last = soak.sample()
+            samples.append(last)
+            if out:
+                out.write(json.dumps(last) + '\n')
+                out.flush()
+            print(f"{last['time_s']:8.0f}s {last['pieces']:>9} pieces {last['games']:>6} games "
+                  f"rss {last['rss_mb'] or 0:7.1f} MB {last['objects']:>8} objects "
+                  f"frame p50 {last['frame_p50_ms']:.3f} ms p99 {last['frame_p99_ms']:.3f} ms")
+            for line in last.get('top_growth', ()):
+                print(f'    {line}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out:
+            out.close()
+
+    if len(samples) < 2:
+        print('not enough samples after the warmup to measure growth')
+        sys.exit(2)
+    failures = check(samples, args.max_rss_growth_mb, args.max_objects_growth, args.max_frame_growth)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+    first, last = samples[0], samples[-1]
+    pieces_per_s = (last['pieces'] - first['pieces']) / (last['time_s'] - first['time_s'])
+    print(f'ok: {pieces_per_s:.0f} pieces/s after the warmup, no growth past the thresholds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Regression tests of the Board grid: line clears and the bookkeeping that goes with them.
+
+Run with: uv run python -m unittest discover tests"""
+import unittest
+
+from tetris import BLOCK_HEIGHT, BLOCK_WIDTH, Block, Board
+
+RED = 255, 0, 0
+BLUE = 0, 0, 255
+
+
+def blocks_at(cells, color=RED):
+    return [Block(color, 0, (col * BLOCK_WIDTH, row * BLOCK_HEIGHT)) for col, row in cells]
+
+
+class BoardTest(unittest.TestCase):
+    def test_lock_completes_rows(self):
+        board = Board(4, 6)
+        self.assertEqual(board.lock(blocks_at([(0, 5), (1, 5), (2, 5)])), [])
+        self.assertEqual(board.lock(blocks_at([(3, 5), (3, 4)])), [5])
+        self.assertEqual(board.row_counts, [0, 0, 0, 0, 1, 4])
+        self.assertEqual(board.column_tops, [5, 5, 5, 4])
+
+    def test_clear_rows_moves_rows_above_down(self):
+        board = Board(4, 6)
+        # two complete rows with a partial row between them and a block above
+        board.lock(blocks_at([(col, 5) for col in range(4)]))
+        board.lock(blocks_at([(0, 4), (2, 4)], BLUE))
+        rows = board.lock(blocks_at([(col, 3) for col in range(4)]) + blocks_at([(2, 2)], BLUE))
+        self.assertEqual(rows, [3])
+        board.clear_rows([3, 5])
+        self.assertEqual(board.row_counts, [0, 0, 0, 0, 1, 2])
+        self.assertEqual(board.cells[5], [BLUE, None, BLUE, None])
+        self.assertEqual(board.cells[4], [None, None, BLUE, None])
+        self.assertTrue(all(cell is None for row in board.cells[:4] for cell in row))
+        self.assertEqual(board.column_tops, [5, 6, 4, 6])
+
+    def test_clear_rows_keeps_counts_and_tops_consistent(self):
+        board = Board(5, 8)
+        board.lock(blocks_at([(col, 7) for col in range(5)] + [(1, 6), (4, 6)] + [(col, 5) for col in range(5)]))
+        board.lock(blocks_at([(3, 4)]))
+        board.clear_rows([5, 7])
+        for row in range(board.height):
+            self.assertEqual(board.row_counts[row], sum(cell is not None for cell in board.cells[row]))
+        for col in range(board.width):
+            top = next((row for row in range(board.height) if board.cells[row][col] is not None), board.height)
+            self.assertEqual(board.column_tops[col], top)
+        self.assertFalse(board.is_occupied(0, 7))
+        self.assertTrue(board.is_occupied(1, 7))
+        self.assertTrue(board.is_occupied(3, 6))
+
+    def test_clear_rows_without_rows(self):
+        board = Board(4, 4)
+        board.lock(blocks_at([(0, 3)]))
+        board.clear_rows([])
+        self.assertEqual(board.row_counts, [0, 0, 0, 1])
+        self.assertEqual(board.column_tops, [3, 4, 4, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
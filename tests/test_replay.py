@@ -0,0 +1,78 @@
+"""Tests of the replay format: games recorded with Recorder and played back with replay.ReplayPlayer.
+
+Run with: uv run python -m unittest discover tests"""
+import os
+import random
+import tempfile
+import unittest
+
+import pygame
+
+from replay import ReplayError, ReplayPlayer, board_text
+from tetris import GAME_KEYS, REPLAY_MAGIC, REPLAY_VERSION, Autoplayer, HeadlessGame, Recorder
+
+
+def record(seed=1, frames=6000, board_size=(10, 20)) -> HeadlessGame:
+    """Plays a game with the autoplayer's keys, random keys for a while now and then and random taps, restarting
+    after game overs, while recording it"""
+    headless_game = HeadlessGame(seed=seed, board_size=board_size)
+    headless_game.game.recorder = Recorder(seed, board_size)
+    autoplayer = Autoplayer(budget_ms=None)
+    rng = random.Random(seed)
+    random_frames = 0
+    for _ in range(frames):
+        if rng.random() < 0.002:
+            random_frames = rng.randint(50, 400)
+            random_keys = set(rng.sample(GAME_KEYS, rng.randint(0, 2)))
+        if random_frames:
+            random_frames -= 1
+            keys = random_keys
+        else:
+            keys = autoplayer.keys(headless_game.game)
+        pressed = {pygame.K_SPACE} if rng.random() < 0.02 else set()
+        headless_game.step(keys, pressed=pressed)
+        if headless_game.game_state.dead:
+            headless_game.restart()
+    return headless_game
+
+
+class ReplayTest(unittest.TestCase):
+    def test_round_trip(self):
+        recorded = record()
+        game, game_state = recorded.game, recorded.game_state
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'game.ttr')
+            game.recorder.save(path)
+            player = ReplayPlayer.load(path)
+        self.assertGreater(game_state.lines_cleared, 0)
+        self.assertGreater(game_state.record, game_state.score)
+        replayed = player.play()
+        self.assertEqual(player.frames, 6000)
+        self.assertEqual(player.pieces, game.pieces_spawned)
+        self.assertEqual(replayed.game_state.score, game_state.score)
+        self.assertEqual(replayed.game_state.record, game_state.record)
+        self.assertEqual(replayed.game_state.lines_cleared, game_state.lines_cleared)
+        self.assertEqual(board_text(replayed), board_text(recorded))
+
+    def test_runs_of_identical_frames_are_compact(self):
+        headless_game = HeadlessGame(seed=1)
+        headless_game.game.recorder = Recorder(1)
+        for _ in range(1000):
+            headless_game.step({pygame.K_LEFT})
+        # one run per piece plus its spawn marker, not a record per frame
+        self.assertLess(len(headless_game.game.recorder.getvalue()), 1000 // 4)
+
+    def test_rejects_older_versions(self):
+        data = bytearray(record(frames=100).game.recorder.getvalue())
+        for version in range(REPLAY_VERSION):
+            data[len(REPLAY_MAGIC)] = version
+            with self.subTest(version=version), self.assertRaises(ReplayError):
+                ReplayPlayer(bytes(data))
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ReplayError):
+            ReplayPlayer(b'TTSS\x03')
+
+
+if __name__ == '__main__':
+    unittest.main()
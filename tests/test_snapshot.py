@@ -0,0 +1,70 @@
+"""Tests of the saved game format: Snapshot.to_bytes and Snapshot.from_bytes.
+
+Run with: uv run python -m unittest discover tests"""
+import unittest
+
+from tetris import SNAPSHOT_MAGIC, SNAPSHOT_VERSION, Autoplayer, HeadlessGame, Snapshot
+
+
+def mid_game(seed=1, steps=1500) -> HeadlessGame:
+    """Returns a game the autoplayer played for "steps" steps, with placed blocks, cleared lines and a falling piece"""
+    headless_game = HeadlessGame(seed=seed)
+    autoplayer = Autoplayer(budget_ms=None)
+    for _ in range(steps):
+        headless_game.step(autoplayer.keys(headless_game.game))
+    return headless_game
+
+
+def piece_of(game) -> tuple:
+    return tuple((block.block_type, block.rotation, block.color, block.rect.topleft) for block in game.player_blocks)
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_round_trip_restores_the_game(self):
+        original = mid_game()
+        game, game_state = original.game, original.game_state
+        self.assertGreater(game_state.lines_cleared, 0)
+        data = Snapshot.take(game, game_state).to_bytes()
+
+        restored = HeadlessGame(seed=2)
+        Snapshot.from_bytes(data).restore(restored.game, restored.game_state)
+        self.assertEqual(restored.game.board.cells, game.board.cells)
+        self.assertEqual(restored.game.board.row_counts, game.board.row_counts)
+        self.assertEqual(restored.game.board.column_tops, game.board.column_tops)
+        self.assertEqual(piece_of(restored.game), piece_of(game))
+        self.assertEqual(restored.game_state.score, game_state.score)
+        self.assertEqual(restored.game_state.lines_cleared, game_state.lines_cleared)
+        self.assertEqual(restored.game.pieces_spawned, game.pieces_spawned)
+        self.assertEqual(restored.game.rng.getstate(), game.rng.getstate())
+        self.assertEqual(Snapshot.take(restored.game, restored.game_state).to_bytes(), data)
+
+    def test_restored_game_plays_the_same(self):
+        original = mid_game(steps=600)
+        restored = HeadlessGame(seed=3)
+        Snapshot.from_bytes(Snapshot.take(original.game, original.game_state).to_bytes()).restore(
+            restored.game, restored.game_state)
+        for _ in range(600):
+            original.step()
+            restored.step()
+        self.assertEqual(restored.game.board.cells, original.game.board.cells)
+        self.assertEqual(restored.game_state.score, original.game_state.score)
+
+    def test_rejects_other_versions(self):
+        headless_game = mid_game(steps=100)
+        data = bytearray(Snapshot.take(headless_game.game, headless_game.game_state).to_bytes())
+        data[len(SNAPSHOT_MAGIC)] = SNAPSHOT_VERSION - 1
+        with self.assertRaises(ValueError):
+            Snapshot.from_bytes(bytes(data))
+
+    def test_rejects_truncated_data(self):
+        headless_game = mid_game(steps=300)
+        data = Snapshot.take(headless_game.game, headless_game.game_state).to_bytes()
+        for size in (0, len(SNAPSHOT_MAGIC), len(SNAPSHOT_MAGIC) + 1, len(data) // 2, len(data) - 1):
+            with self.subTest(size=size), self.assertRaises(ValueError):
+                Snapshot.from_bytes(data[:size])
+        with self.assertRaises(ValueError):
+            Snapshot.from_bytes(b'TTRP' + data[len(SNAPSHOT_MAGIC):])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,48 +1,291 @@
-import copy
+import argparse
+import csv
+import functools
+import json
+import math
+import os
 import random
-from collections import defaultdict
-from collections.abc import Sequence
+import struct
+import threading
+import time
+from collections import deque
+
+# taken before importing pygame, for --startup-profile
+STARTED = time.perf_counter()
 
 import pygame
 
+# the game rules place blocks in board coordinates, BLOCK_WIDTH x BLOCK_HEIGHT per cell, laid out for a screen of
+# RESOLUTION. Screens of other sizes draw everything scaled, see Viewport.
 RESOLUTION = 500, 900
 BLOCKS_HORIZONTAL = 10
 BLOCKS_VERTICAL = 20
 BLOCK_WIDTH = RESOLUTION[0] / BLOCKS_HORIZONTAL
 BLOCK_HEIGHT = RESOLUTION[1] / BLOCKS_VERTICAL
 
-ADD_BLOCK = pygame.USEREVENT + 1
+# the board size can be set at runtime within these limits, boards larger than the screen scroll
+MIN_BOARD_SIZE = 4, 4
+MAX_BOARD_SIZE = 200, 2000
+# cells kept between the player's piece and the edges of a scrolling viewport
+VIEWPORT_MARGIN = 3, 4
+
+LINE_SCORE = 10
+PIECE_SCORE = 1
+
+FONT_FACE = 'arial'
+# sizes of all the texts, loaded in the background at startup, and how many times loading is tried before giving up
+FONT_SIZES = (14, 20, 32, 48)
+ASSET_LOAD_ATTEMPTS = 3
+# number of rendered texts kept by render_text and of fonts kept by get_font, every screen size has its own font sizes
+TEXT_CACHE_SIZE = 128
+FONT_CACHE_SIZE = 32
+
+# more changed regions than this in a frame present the whole screen
+MAX_DIRTY_RECTS = 32
+
+# number of block tiles kept by get_block_surface and get_preview_surface and of removed blocks kept for reuse
+BLOCK_SURFACE_CACHE_SIZE = 256
+BLOCK_POOL_SIZE = 256
+
+# the game rules run in fixed steps of STEP_MS, independently of the frame rate, which only limits rendering
+STEP_MS = 1000 // 60
+FPS = 60
+# at most this much game time is caught up after a stalled frame
+MAX_CATCH_UP_MS = 250
+
+# every move happens as soon as its key is pressed and repeats while it is held: sideways after the delayed auto shift
+# and then at the auto repeat rate (0 moves to the wall at once), the other moves at a fixed rate
+DAS_MS = 170
+ARR_MS = 50
+SOFT_DROP_MS = 70
+ROTATE_REPEAT_MS = 200
+HARD_DROP_REPEAT_MS = 140
+GRAVITY_MS = 700
+
+# stages timed by the Profiler, in the order they are shown and exported
+PROFILE_STAGES = ('input', 'events', 'update', 'collision', 'background', 'preview', 'sprites', 'hud', 'present',
+                  'latency', 'frame')
+# samples per stage the overlay percentiles are computed from, frames between overlay refreshes and histogram buckets
+# (bucket i counts the samples shorter than 2 ** i microseconds)
+PROFILE_WINDOW = 300
+PROFILE_OVERLAY_REFRESH = 30
+PROFILE_BUCKETS = 24
+
+# time the Autoplayer may spend choosing a placement, weights of the board features it scores placements with and how
+# long the game over screen stays up before it restarts the game
+AUTOPLAY_BUDGET_MS = 2
+AUTOPLAY_WEIGHTS = {'height': -0.510066, 'lines': 0.760666, 'holes': -0.35663, 'bumpiness': -0.184483}
+AUTOPLAY_RESTART_MS = 3000
+
+# events Telemetry writes, with the names of their values. A full queue drops events instead of blocking the game,
+# the writer flushes batches of events every TELEMETRY_FLUSH_MS and rotates the log files at TELEMETRY_FILE_SIZE bytes
+TELEMETRY_EVENTS = {
+    'spawn': ('piece', 'type'),
+    'lock': ('piece', 'type'),
+    'line_clear': ('lines', 'total_lines'),
+    'score': ('score', 'gained'),
+    'death': ('score', 'lines', 'pieces'),
+    'restart': ('record',),
+    'dropped': ('count',),
+}
+TELEMETRY_EVENT_CODES = {event: code for code, event in enumerate(TELEMETRY_EVENTS)}
+TELEMETRY_QUEUE_SIZE = 4096
+TELEMETRY_FLUSH_MS = 200
+TELEMETRY_FILE_SIZE = 8 * 2 ** 20
+TELEMETRY_BACKUPS = 5
+TELEMETRY_MAGIC = b'TTEV'
+TELEMETRY_VERSION = 1
+
+# the keys that control the game, in the order of their bits in replays
+GAME_KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_SPACE, pygame.K_d)
+
+REPLAY_MAGIC = b'TTRP'
+REPLAY_VERSION = 3
+REPLAY_RESTART = 0
+SNAPSHOT_MAGIC = b'TTSS'
+SNAPSHOT_VERSION = 3
+
+# (column, row) of the cells of every piece type in each of its rotation states, in the order the pieces rotate
+# (anti-clockwise). Rows above the board are negative, the first state is the one pieces spawn in.
+PIECE_ROTATIONS = {
+    1: [[(4, -1)]],
+    2: [[(3, -1), (4, -1), (5, -1), (6, -1)],
+        [(5, 1), (5, 0), (5, -1), (5, -2)]],
+    3: [[(4, 0), (4, -1), (5, 0), (5, -1)]],
+    4: [[(4, 1), (4, 0), (4, -1), (5, 1)],
+        [(5, 1), (4, 1), (3, 1), (5, 0)],
+        [(4, -1), (4, 0), (4, 1), (3, -1)],
+        [(3, 0), (4, 0), (5, 0), (3, 1)]],
+    5: [[(4, 0), (4, -1), (5, 1), (5, 0)],
+        [(4, 0), (3, 1), (4, 1), (5, 0)]],
+    6: [[(4, -1), (5, 0), (5, -1), (6, -1)],
+        [(5, -2), (5, 0), (5, -1), (6, -1)],
+        [(5, -2), (4, -1), (5, -1), (6, -1)],
+        [(5, -2), (4, -1), (5, -1), (5, 0)]],
+}
+# every rotation state as (cells, leftmost column, rightmost column, lowest row)
+PIECE_STATES = {
+    block_type: [(tuple(cells), min(col for col, _ in cells), max(col for col, _ in cells), max(row for _, row in cells))
+                 for cells in states]
+    for block_type, states in PIECE_ROTATIONS.items()
+}
+# offsets tried in order when a rotated piece overlaps placed blocks
+WALL_KICKS = ((0, 0), (-1, 0), (1, 0), (0, -1), (-2, 0), (2, 0))
 
 
 def main():
-    pygame.init()
-
-    game = Game(RESOLUTION)
-    game_state = GameState()
-
+    parser = argparse.ArgumentParser(description="A tetris game")
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help="only present the screen regions that changed instead of the whole screen every frame")
+    parser.add_argument('--seed', type=int, help="seed of the piece sequence, random by default")
+    parser.add_argument('--board', type=parse_board_size, default=(BLOCKS_HORIZONTAL, BLOCKS_VERTICAL),
+                        metavar='WxH', help=f"board size in cells, up to {MAX_BOARD_SIZE[0]}x{MAX_BOARD_SIZE[1]} "
+                                            f"(default {BLOCKS_HORIZONTAL}x{BLOCKS_VERTICAL})")
+    parser.add_argument('--record', metavar='FILE', help="record the session to FILE for replay.py")
+    parser.add_argument('--telemetry', metavar='FILE',
+                        help="log the game events to FILE as JSON lines, or in binary if FILE ends with .bin. Full "
+                             f"files are rotated to FILE.1 ... FILE.{TELEMETRY_BACKUPS}")
+    parser.add_argument('--state', metavar='FILE', help="F5 saves the game to FILE and F9 loads it back")
+    parser.add_argument('--fps', type=int, default=FPS, help=f"frame rate limit, 0 for none (default {FPS})")
+    parser.add_argument('--vsync', action='store_true',
+                        help="synchronize frames with the display refresh, the display scales the frames of a resized "
+                             "window")
+    parser.add_argument('--fullscreen', action='store_true', help="draw the game at the resolution of the display")
+    parser.add_argument('--das', type=int, default=DAS_MS, metavar='MS',
+                        help=f"delay before a held sideways key repeats (default {DAS_MS})")
+    parser.add_argument('--arr', type=int, default=ARR_MS, metavar='MS',
+                        help=f"interval of the sideways repeats, 0 moves to the wall at once (default {ARR_MS})")
+    parser.add_argument('--autoplay', action='store_true',
+                        help="let the computer play, restarting after every game over (attract mode)")
+    parser.add_argument('--profile', action='store_true',
+                        help="time the stages of every frame and the input latency and show them in an overlay, "
+                             "toggled with F3")
+    parser.add_argument('--profile-out', metavar='FILE',
+                        help="write the stage timings to FILE (.json or .csv) at exit, implies --profile")
+    parser.add_argument('--startup-profile', action='store_true',
+                        help="print how long the startup steps took, up to the first frame and the loaded assets")
+    args = parser.parse_args()
+    if args.das < 0 or args.arr < 0:
+        parser.error("--das and --arr can't be negative")
+    if args.record and args.state:
+        parser.error("a recording can't be replayed past a loaded state, --record and --state can't be combined")
+    startup = StartupTimer(STARTED)
+    startup.mark('import')
+
+    # only what the game uses: no audio, joysticks or other devices
+    pygame.display.init()
+    pygame.font.init()
+    assets = AssetLoader(startup)
+    startup.mark('init')
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    # game time only moves in fixed steps, so the game plays the same at any frame rate and replays exactly
     pygame.display.set_caption("Tetris")
-    bg = get_bg()
+    game = Game(RESOLUTION, clock=VirtualClock(), seed=seed, vsync=args.vsync, board_size=args.board,
+                das_ms=args.das, arr_ms=args.arr, fullscreen=args.fullscreen)
+    startup.mark('window')
+    game_state = GameState()
+    if args.record:
+        game.recorder = Recorder(seed, args.board, args.das, args.arr)
+    game.state_path = args.state
+    if args.telemetry:
+        game.telemetry = Telemetry(args.telemetry)
+        # the first piece was spawned by Game() before the telemetry was attached
+        game.telemetry.emit('spawn', game.clock.get_ticks(), game.pieces_spawned,
+                            next(iter(game.player_blocks)).block_type)
+    if args.autoplay:
+        game.autoplayer = Autoplayer()
+        game_state.started = True
+    if args.profile or args.profile_out:
+        game.profiler.enabled = game.profiler.overlay = True
+        game.keyboard.timed = True
+    profiler = game.profiler
 
     clock = pygame.time.Clock()
 
+    scene = None
+    bg = None
+    fonts_ready = False
     while game_state.running:
+        # the first frame doesn't wait for the frame rate limit
+        frame_ms = clock.tick(args.fps if scene else 0)
+        frame_start = profiler.start()
+        # the window was resized, the layout and the scaled assets are rebuilt once for the new size
+        if (screen := pygame.display.get_surface()).get_size() != game.viewport.screen_size:
+            game.resize(screen)
+        if (game_state.started, game_state.dead) != scene:
+            scene = (game_state.started, game_state.dead)
+            scene_ms = 0
+            game.dirty_rects.invalidate()
+            game.accumulator = 0
+        scene_ms += frame_ms
+        # the whole screen changes when the assets finish loading
+        if (new_bg := assets.background()) is not bg or assets.fonts_ready.is_set() != fonts_ready:
+            bg = new_bg
+            fonts_ready = assets.fonts_ready.is_set()
+            game.dirty_rects.invalidate()
+
         if not game_state.started:
-            start_logic(game, game_state)
+            start_logic(game, game_state, fonts_ready)
         else:
             if game_state.dead:
-                dead_logic(game, game_state)
+                dead_logic(game, game_state, fonts_ready)
+                if game.autoplayer and game_state.dead and scene_ms > AUTOPLAY_RESTART_MS:
+                    restart_game(game, game_state)
             else:
-                main_logic(bg, game, game_state)
+                main_logic(bg, game, game_state, frame_ms, fonts_ready)
+        if profiler.overlay and fonts_ready:
+            overlay_rect = profiler.draw_overlay(game.screen)
+            game.dirty_rects.watch('profiler', profiler.overlay_lines, overlay_rect)
+
+        start = profiler.start()
+        rects = game.dirty_rects.take()
+        if not args.dirty_rects:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
+        start = profiler.lap('present', start)
+        for pressed_at in game.keyboard.take_shown():
+            profiler.record('latency', start - pressed_at)
+        profiler.end_frame(frame_start)
+        if not assets.loading() and not assets.loaded.is_set():
+            if not assets.attempts:
+                # started after the first frame, image decoding holds the GIL and would delay it
+                startup.mark('first frame')
+            elif assets.attempts >= ASSET_LOAD_ATTEMPTS:
+                raise assets.error
+            assets.start()
+        if args.startup_profile and assets.loaded.is_set() and not startup.reported:
+            print(startup.report())
+
+    if game.recorder:
+        game.recorder.save(args.record)
+    if game.telemetry:
+        game.telemetry.close()
+        if game.telemetry.dropped:
+            print(f"telemetry dropped {game.telemetry.dropped} events")
+    if args.profile_out:
+        profiler.export(args.profile_out)
+    pygame.quit()
 
-        pygame.display.flip()
-        clock.tick(60)
 
-    pygame.quit()
+def parse_board_size(text: str) -> tuple[int, int]:
+    try:
+        width, height = map(int, text.lower().split('x'))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}") from err
+    if not (MIN_BOARD_SIZE[0] <= width <= MAX_BOARD_SIZE[0] and MIN_BOARD_SIZE[1] <= height <= MAX_BOARD_SIZE[1]):
+        raise argparse.ArgumentTypeError(f"board size must be between {MIN_BOARD_SIZE[0]}x{MIN_BOARD_SIZE[1]} and "
+                                         f"{MAX_BOARD_SIZE[0]}x{MAX_BOARD_SIZE[1]}")
+    return width, height
 
 
-def start_logic(game, game_state):
+def start_logic(game, game_state, show_text=True):
+    """Handles the start screen, its text is left out while the fonts are still loading"""
     for event in pygame.event.get():
-        if event.type == pygame.KEYDOWN:
+        if event.type == pygame.KEYUP:
+            game.keyboard.handle(event)
+        elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE:
                 game_state.running = False
             else:
@@ -51,101 +294,298 @@ def start_logic(game, game_state):
         elif event.type == pygame.QUIT:
             game_state.running = False
     game.screen.fill((0, 0, 0))
-    text_lines = ['Press any key to start']
-    write_text_lines(text_lines, game.screen)
+    if show_text:
+        text_lines = ['Press any key to start']
+        write_text_lines(text_lines, game.screen)
 
 
-def dead_logic(game, game_state):
+def dead_logic(game, game_state, show_text=True):
+    """Handles the game over screen, its text is left out while the fonts are still loading"""
     for event in pygame.event.get():
-        if event.type == pygame.KEYDOWN:
+        if event.type == pygame.KEYUP:
+            # keys held when the game ended are released here
+            game.keyboard.handle(event)
+        elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE:
                 game_state.running = False
             else:
-                game_state.dead = False
-                game_state.score = 0
-                game.placed_blocks.empty()
-                game.all_sprites.empty()
-                game.player_blocks.empty()
                 pygame.event.clear()
-                game.player_blocks.add(*create_player_blocks())
-                game.all_sprites.add(*game.player_blocks)
+                restart_game(game, game_state)
                 continue
         elif event.type == pygame.QUIT:
             game_state.running = False
     game.screen.fill((0, 0, 0))
-    text_lines = ['Game Over!', f'Score: {game_state.score}', f'Record: {game_state.record}',
-                  'Press any key to restart']
-    write_text_lines(text_lines, game.screen)
-
-
-def main_logic(bg, game, game_state):
+    if show_text:
+        text_lines = ['Game Over!', f'Score: {game_state.score}', f'Record: {game_state.record}',
+                      'Press any key to restart']
+        write_text_lines(text_lines, game.screen)
+
+
+def restart_game(game, game_state):
+    game_state.dead = False
+    game_state.score = 0
+    game_state.lines_cleared = 0
+    game_state.pieces_placed = 0
+    game.board.clear()
+    BLOCK_POOL.release(*game.player_blocks)
+    game.all_sprites.empty()
+    game.previous_positions = {}
+    # keys held in the last game don't carry over, they repeat again from a new press
+    game.keyboard.reset()
+    game.blocks_updater.next_repeats.clear()
+    game.dirty_rects.invalidate()
+    if game.recorder:
+        game.recorder.restart()
+    if game.telemetry:
+        game.telemetry.emit('restart', game.clock.get_ticks(), game_state.record)
+    spawn_player_blocks(game)
+
+
+def spawn_player_blocks(game):
+    game.pieces_spawned += 1
+    game.player_blocks.add(*create_player_blocks(game.rng, game.board.spawn_dx))
+    game.all_sprites.add(*game.player_blocks)
+    block_type = next(iter(game.player_blocks)).block_type
+    if game.recorder:
+        game.recorder.spawn(block_type)
+    if game.telemetry:
+        game.telemetry.emit('spawn', game.clock.get_ticks(), game.pieces_spawned, block_type)
+
+
+def main_logic(bg, game, game_state, frame_ms=STEP_MS, show_text=True):
+    """Runs as many fixed steps of the game rules as fit in the time since the last frame and draws the game between
+    the last two steps, without the texts while the fonts are still loading"""
+    start = game.profiler.start()
     for event in pygame.event.get():
+        game.input_events.append(event)
+        game.keyboard.handle(event)
+    game.profiler.lap('input', start)
+    advance_game(game, game_state, frame_ms)
+    draw_game(bg, game, game_state, game.accumulator / STEP_MS, show_text)
+
+
+def advance_game(game, game_state, frame_ms=STEP_MS):
+    """Runs the fixed steps of the game rules that fit in "frame_ms" and the time left over from the last frame, with
+    the keys of the keyboard or of the autoplayer"""
+    game.accumulator = min(game.accumulator + frame_ms, MAX_CATCH_UP_MS)
+    while game.accumulator >= STEP_MS and game_state.running and not game_state.dead:
+        game.accumulator -= STEP_MS
+        game.clock.advance(STEP_MS)
+        game.previous_positions = {block: block.rect.topleft for block in game.player_blocks}
+        pressed_keys = game.keyboard.take()
+        if game.autoplayer:
+            pressed_keys = PressedKeys(game.autoplayer.keys(game))
+        step_game(game.input_events, pressed_keys, game, game_state)
+        game.input_events.clear()
+
+
+def step_game(events, pressed_keys: 'PressedKeys', game, game_state):
+    """Runs the game rules for one frame"""
+    if game.recorder:
+        game.recorder.tick(pressed_keys, game.clock.get_ticks())
+    start = game.profiler.start()
+    handle_events(events, game, game_state)
+    game.profiler.lap('events', start)
+    update_logic(pressed_keys, game, game_state)
+
+
+def handle_events(events, game, game_state):
+    for event in events:
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE:
                 game_state.running = False
+            elif event.key == pygame.K_F3:
+                game.profiler.toggle_overlay()
+                game.dirty_rects.invalidate()
+            elif event.key == pygame.K_F5 and game.state_path:
+                try:
+                    Snapshot.take(game, game_state).save(game.state_path)
+                except OSError as e:
+                    print(f"can't save {game.state_path}: {e}")
+            elif event.key == pygame.K_F9 and game.state_path:
+                try:
+                    snapshot = Snapshot.load(game.state_path)
+                except (OSError, ValueError) as e:
+                    print(f"can't load {game.state_path}: {e}")
+                    continue
+                snapshot.restore(game, game_state)
+                # the other events of this frame were for the replaced game
+                return
         elif event.type == pygame.QUIT:
             game_state.running = False
-        elif event.type == ADD_BLOCK:
-            game.placed_blocks.add(*game.player_blocks)
-            game.player_blocks.empty()
-            game.player_blocks.add(*create_player_blocks())
-            game.all_sprites.add(*game.player_blocks)
-
-            nr_connections_complete_line = BLOCKS_HORIZONTAL - 1
-            # dict where the key is the bottom and values are lefts and rights
-            left_right = defaultdict(list)
-
-            for block in game.placed_blocks:
-                left_right[block.rect.bottom].append(block.rect.left)
-                left_right[block.rect.bottom].append(block.rect.right)
-
-            for bottom in sorted(left_right):
-                uniq = set(left_right[bottom])
-                if len(left_right[bottom]) - len(uniq) == nr_connections_complete_line:
-                    # line complete
-                    for block in game.placed_blocks.copy():
-                        if block.rect.bottom == bottom:
-                            block.remove(game.placed_blocks, game.all_sprites)
-                    for block in game.placed_blocks:
-                        if block.rect.bottom < bottom:
-                            block.rect.move_ip(0, RESOLUTION[1] / BLOCKS_VERTICAL)
-                    game.congratulations.active = True
-                    game_state.score += 10
-
-            game_state.score += 1
-            if game_state.score > game_state.record:
-                game_state.record = game_state.score
-
-    pressed_keys = pygame.key.get_pressed()
-    game.blocks_updater.update_player_blocks(pressed_keys, game.player_blocks, game.placed_blocks)
-
-    if (collided := pygame.sprite.groupcollide(game.player_blocks, game.placed_blocks, False, False)) \
-            or group_has_bottom(game.player_blocks, RESOLUTION[1]):
+
+
+def lock_piece(game, game_state):
+    """Places the player's piece on the board, clears the lines it completed and spawns the next piece"""
+    telemetry = game.telemetry
+    if telemetry:
+        ticks = game.clock.get_ticks()
+        telemetry.emit('lock', ticks, game.pieces_spawned, next(iter(game.player_blocks)).block_type)
+    score = game_state.score
+    viewport = game.viewport
+    # the piece's region, its blocks are drawn from the board from now on
+    rects = [block.rect for block in game.player_blocks]
+    game.dirty_rects.add(viewport.to_screen(rects[0].unionall(rects[1:])).clip(viewport.area))
+    full_rows = game.board.lock(game.player_blocks)
+    game.player_blocks.empty()
+    # the blocks go back to BLOCK_POOL and the next piece reuses them, it must not be drawn moving from here
+    game.previous_positions = {}
+
+    if full_rows:
+        game.board.clear_rows(full_rows)
+        # the cleared rows and everything above them moved
+        cleared = pygame.Rect(0, 0, game.board.pixel_width, (max(full_rows) + 1) * BLOCK_HEIGHT)
+        game.dirty_rects.add(viewport.to_screen(cleared).clip(viewport.area))
+        game.congratulations.active = True
+        game_state.score += LINE_SCORE * len(full_rows)
+        game_state.lines_cleared += len(full_rows)
+        if telemetry:
+            telemetry.emit('line_clear', ticks, len(full_rows), game_state.lines_cleared)
+
+    game_state.score += PIECE_SCORE
+    game_state.pieces_placed += 1
+    if game_state.score > game_state.record:
+        game_state.record = game_state.score
+    if telemetry:
+        telemetry.emit('score', ticks, game_state.score, game_state.score - score)
+    spawn_player_blocks(game)
+
+
+def update_logic(pressed_keys: 'PressedKeys', game, game_state):
+    start = game.profiler.start()
+    game.blocks_updater.update_player_blocks(pressed_keys, game.player_blocks, game.board)
+    start = game.profiler.lap('update', start)
+
+    if (collided := game.board.collides(game.player_blocks)) \
+            or group_has_bottom(game.player_blocks, game.board.pixel_height):
+        if collided:
+            align_collided(game.player_blocks, game.board)
         if group_top_is_above_screen(game.player_blocks):
             game_state.dead = True
+            if game.telemetry:
+                game.telemetry.emit('death', game.clock.get_ticks(), game_state.score, game_state.lines_cleared,
+                                    game_state.pieces_placed)
         else:
-            if collided:
-                align_collided(collided, game.player_blocks)
-            pygame.event.post(pygame.event.Event(ADD_BLOCK))
-
-    game.screen.blit(bg, (0, 0))
-    draw_grid(game.screen)
-    draw_drop_preview(game.screen, game.player_blocks, game.placed_blocks)
+            # in the same step, the landed piece is never drawn overlapping the board
+            lock_piece(game, game_state)
+    game.profiler.lap('collision', start)
+
+
+def draw_game(bg, game, game_state, alpha=1.0, show_text=True):
+    """Draws the game, "alpha" is how far the time of the frame is between the last two steps of the game rules. The
+    score and the messages are left out without "show_text"."""
+    profiler = game.profiler
+    viewport = game.viewport
+    if viewport.follow(game.player_blocks):
+        game.dirty_rects.invalidate()
+    start = profiler.start()
+    layer = game.static_layer.get(game.screen.get_size(), bg, viewport.area, viewport.cell_size)
+    # after a full frame only the regions drawn over or changed since are redrawn, so frames cost about the same at
+    # any screen size
+    damaged = None if game.dirty_rects.full_screen else game.dirty_rects.damaged()
+    if damaged is None:
+        game.screen.blit(layer, (0, 0))
+    else:
+        for rect in damaged:
+            game.screen.blit(layer, rect, rect)
+    start = profiler.lap('background', start)
+    # the board is drawn inside the viewport only, pieces above it stay hidden
+    game.screen.set_clip(viewport.area)
+    preview_rects = draw_drop_preview(game.screen, game.player_blocks, game.board, viewport)
+    start = profiler.lap('preview', start)
+
+    if damaged is None:
+        draw_placed_blocks(game.screen, game.board, viewport)
+    else:
+        for rect in damaged:
+            game.screen.set_clip(rect.clip(viewport.area))
+            draw_placed_blocks(game.screen, game.board, viewport, rect)
+        game.screen.set_clip(viewport.area)
+    moving_rects = interpolated_rects(game.player_blocks, game.previous_positions, alpha, viewport)
+    for entity, rect in zip(game.player_blocks, moving_rects):
+        game.screen.blit(get_block_surface(entity.color, viewport.cell_size), rect)
+    game.screen.set_clip(None)
+    start = profiler.lap('sprites', start)
+
+    score_rect = message_rect = None
+    if show_text:
+        score_rect = write_score(game_state.score, game.screen)
+        message_rect = game.congratulations.display(game.screen)
+    profiler.lap('hud', start)
+
+    # the bounds of the piece and of the preview, a few larger regions are cheaper to redraw and present than a region
+    # per block
+    moving_rects = [rects[0].unionall(rects[1:]) for rects in (moving_rects, preview_rects) if rects]
+    if message_rect:
+        moving_rects.append(message_rect)
+    game.dirty_rects.set_moving(moving_rects)
+    if score_rect:
+        game.dirty_rects.watch('score', game_state.score, score_rect)
+
+
+def draw_placed_blocks(screen: pygame.Surface, board: 'Board', viewport: 'Viewport', area: pygame.Rect | None = None):
+    """Draws the placed blocks in the viewport, or only those overlapping "area" of the screen, the cost only depends
+    on the viewport size"""
+    dx, dy = viewport.offset
+    width, height = cell_size = viewport.cell_size
+    cols = viewport.visible_cols(area)
+    tiles = []
+    for row in viewport.visible_rows(area):
+        if not board.row_counts[row]:
+            continue
+        line = board.cells[row]
+        y = height * row + dy
+        for col in cols:
+            if (color := line[col]) is not None:
+                tiles.append((get_block_surface(color, cell_size), (width * col + dx, y)))
+    screen.blits(tiles, doreturn=False)
+
+
+def interpolated_rects(player_blocks: pygame.sprite.Group, previous_positions: dict, alpha: float,
+                       viewport: 'Viewport') -> list[pygame.Rect]:
+    """Returns the screen rects of the player blocks "alpha" of the way from their previous positions to the current
+    ones. Blocks that jumped more than a cell (drops, new pieces) are shown where they are."""
+    rects = []
+    for block in player_blocks:
+        x, y = block.rect.topleft
+        previous = previous_positions.get(block)
+        if previous is not None and alpha < 1:
+            dx = previous[0] - x
+            dy = previous[1] - y
+            if abs(dx) <= BLOCK_WIDTH and abs(dy) <= BLOCK_HEIGHT:
+                x += dx * (1 - alpha)
+                y += dy * (1 - alpha)
+        rects.append(pygame.Rect(viewport.to_screen_point(x, y), viewport.cell_size))
+    return rects
 
-    for entity in game.all_sprites:
-        game.screen.blit(entity.surf, entity.rect)
 
-    write_score(game_state.score, game.screen)
-    game.congratulations.display(game.screen)
+def get_bg() -> pygame.Surface:
+    bg = load_bg()
+    return bg.convert() if pygame.display.get_surface() else bg
 
 
-def get_bg() -> pygame.Surface:
+def load_bg() -> pygame.Surface:
     try:
-        return pygame.image.load("stars.png").convert()
+        return pygame.image.load("stars.png")
     except FileNotFoundError:
-        surf = pygame.Surface((RESOLUTION[0], RESOLUTION[1]))
-        surf.fill((27, 49, 69))
-        return surf
+        return get_plain_bg()
+
+
+def get_plain_bg() -> pygame.Surface:
+    surf = pygame.Surface((RESOLUTION[0], RESOLUTION[1]))
+    surf.fill((27, 49, 69))
+    return surf
+
+
+def layout_scale(screen_size: tuple[int, int]) -> float:
+    """Returns how much larger than RESOLUTION the game is drawn on a screen of "screen_size", it fits in both
+    directions"""
+    return min(screen_size[0] / RESOLUTION[0], screen_size[1] / RESOLUTION[1])
+
+
+def scale_size(size: float, scale: float) -> int:
+    """Returns a length (font size, margin) of the RESOLUTION layout in whole pixels of a screen of "scale" """
+    return max(1, round(size * scale))
 
 
 def group_has_bottom(group: pygame.sprite.Group, bottom: int):
@@ -163,9 +603,9 @@ def group_top_is_above_screen(group: pygame.sprite.Group):
     return False
 
 
-def group_bottom_is_below_screen(group: pygame.sprite.Group):
+def group_bottom_is_below_screen(group: pygame.sprite.Group, bottom=RESOLUTION[1]):
     for sprite in group:
-        if sprite.rect.bottom > RESOLUTION[1]:
+        if sprite.rect.bottom > bottom:
             return True
     return False
 
@@ -175,12 +615,6 @@ def group_bottom(group: pygame.sprite.Group):
     return max(map(lambda sprt: sprt.rect.bottom, group), default=0)
 
 
-def group_bottom_sprites(group: pygame.sprite.Group):
-    """Returns a list of the group's sprites which have the lowest (on the screen) bottom"""
-    bottom = max(map(lambda sprt: sprt.rect.bottom, group), default=RESOLUTION[1])
-    return list(filter(lambda sprt: sprt.rect.bottom == bottom, group))
-
-
 def group_left(group: pygame.sprite.Group):
     return min(map(lambda sprt: sprt.rect.left, group), default=RESOLUTION[0])
 
@@ -189,478 +623,564 @@ def group_right(group: pygame.sprite.Group):
     return max(map(lambda sprt: sprt.rect.right, group), default=0)
 
 
-def group_top(group: pygame.sprite.Group, rect: pygame.Rect):
-    """Returns the highest (on the screen) top of the group's sprites whose rects have the same centerx as "rect.centerx"
-    and lower (on the screen) centery than "rect.centery" """
-    same_centerx_lower_centery = filter(lambda sprt: sprt.rect.centerx == rect.centerx
-                                                     and sprt.rect.centery >= rect.centery, group)
-    return min(map(lambda sprt: sprt.rect.top, same_centerx_lower_centery), default=RESOLUTION[1])
+def align_collided(player_blocks: pygame.sprite.Group, board: 'Board'):
+    """Moves the player blocks up until they no longer overlap the placed blocks"""
+    while board.collides(player_blocks):
+        for block in player_blocks:
+            block.rect.move_ip(0, -BLOCK_HEIGHT)
 
 
-def align_collided(collided: dict[pygame.sprite.Sprite, list[pygame.sprite.Sprite]],
-                   player_blocks: pygame.sprite.Group):
-    diff = 0
-    for block in collided:
-        for block2 in collided[block]:
-            diff = block2.rect.top - block.rect.bottom
-            break
-        if collided[block]:
-            break
-    for block in player_blocks:
-        block.rect.move_ip(0, diff)
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(size: int, face=FONT_FACE) -> pygame.font.Font:
+    """Loads the (face, size) fonts, keeping the most recently used ones"""
+    return pygame.font.SysFont(face, size)
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(text: str, size: int, color=(255, 255, 255), background=(0, 0, 0), alpha=None) -> pygame.Surface:
+    """Returns the rendered text from a cache of the most recently used texts, the surface must not be modified"""
+    text_surface = get_font(size).render(text, True, color, background)
+    if alpha is not None:
+        text_surface.set_alpha(alpha)
+    return text_surface
 
 
 def write_text_lines(lines: list[str], screen: pygame.Surface, font_size=32):
-    font = pygame.font.SysFont('arial', font_size)
-    text_surfaces = []
-    for line in lines:
-        text_surfaces.append(font.render(line, True, (255, 255, 255), (0, 0, 0)))
+    font_size = scale_size(font_size, layout_scale(screen.get_size()))
+    text_surfaces = [render_text(line, font_size) for line in lines]
+    center_x, center_y = screen.get_rect().center
     for i, surface in enumerate(text_surfaces):
-        text_rect = surface.get_rect(center=(RESOLUTION[0] / 2, (RESOLUTION[1] / 2) + i * font_size))
+        text_rect = surface.get_rect(center=(center_x, center_y + i * font_size))
         screen.blit(surface, text_rect)
 
 
 def write_score(score, screen):
-    font = pygame.font.SysFont('arial', 20)
-    text_surface = font.render(f"Score: {score}", True, (255, 255, 255), (0, 0, 0))
-    text_surface.set_alpha(150)
-    text_rect = text_surface.get_rect(topleft=(25, 25))
+    scale = layout_scale(screen.get_size())
+    text_surface = render_text(f"Score: {score}", scale_size(20, scale), alpha=150)
+    text_rect = text_surface.get_rect(topleft=(scale_size(25, scale), scale_size(25, scale)))
     screen.blit(text_surface, text_rect)
+    return text_rect
 
 
 def draw_grid(screen: pygame.Surface,
-              block_size=(RESOLUTION[0] // BLOCKS_HORIZONTAL, RESOLUTION[1] // BLOCKS_VERTICAL)):
-    for x in range(0, RESOLUTION[0], block_size[0]):
-        for y in range(0, RESOLUTION[1], block_size[1]):
-            rect = pygame.Rect(x, y, block_size[0], block_size[1])
-            surf = pygame.Surface(rect.size)
-            surf.set_alpha(50)
-            surf.fill((255, 255, 255), surf.get_rect().inflate(-1, -1))
-            screen.blit(surf, rect)
-
-
-def draw_drop_preview(screen: pygame.Surface, player_blocks: pygame.sprite.Group, placed_blocks: pygame.sprite.Group):
-    diffs = []
-    for block in player_blocks:
-        top_placed = group_top(placed_blocks, block.rect)
-        diffs.append(top_placed - block.rect.bottom)
-    min_diff = min(diffs)
-    moved_rects = []
-    for block in player_blocks:
-        moved_rects.append(block.rect.move(0, min_diff))
+              block_size=(RESOLUTION[0] // BLOCKS_HORIZONTAL, RESOLUTION[1] // BLOCKS_VERTICAL),
+              area: pygame.Rect | None = None):
+    """Draws the grid over "area", the whole screen by default"""
+    area = area or screen.get_rect()
+    surf = pygame.Surface(block_size)
+    surf.set_alpha(50)
+    surf.fill((255, 255, 255), surf.get_rect().inflate(-1, -1))
+    for x in range(area.left, area.right, block_size[0]):
+        for y in range(area.top, area.bottom, block_size[1]):
+            screen.blit(surf, (x, y))
+
+
+@functools.lru_cache(maxsize=BLOCK_SURFACE_CACHE_SIZE)
+def get_preview_surface(size: tuple[int, int]) -> pygame.Surface:
+    surf = pygame.Surface(size)
+    surf.set_alpha(50)
+    surf.fill((0, 0, 0), surf.get_rect())
+    return surf
+
+
+def draw_drop_preview(screen: pygame.Surface, player_blocks: pygame.sprite.Group, board: 'Board',
+                      viewport: 'Viewport'):
+    """Shades where the player blocks would land and returns the shaded screen rects"""
+    diff = board.drop_distance(player_blocks) * BLOCK_HEIGHT
+    moved_rects = [viewport.to_screen(block.rect.move(0, diff)) for block in player_blocks]
     for rect in moved_rects:
-        surf = pygame.Surface(rect.size)
-        surf.set_alpha(50)
-        surf.fill((0, 0, 0), surf.get_rect())
-        screen.blit(surf, rect)
+        screen.blit(get_preview_surface(rect.size), rect)
+    return moved_rects
 
 
-def create_player_blocks() -> list['Block']:
+def create_player_blocks(rng: random.Random = random, dx=0) -> list['Block']:
     player_blocks = []
-    color = tuple(random.randint(90, 245) for _ in range(3))
-    block_type = random.randint(1, 6)
-    player_blocks.extend(get_block(block_type, color))
+    color = tuple(rng.randint(90, 245) for _ in range(3))
+    block_type = rng.randint(1, 6)
+    player_blocks.extend(get_block(block_type, color, dx))
     return player_blocks
 
 
-def get_block(block_type: int, color: tuple[int, int, int]) -> list['Block']:
-    block_type = block_type if block_type in range(1, 7) else 1
-    rects_topleft = []
-    if block_type == 1:
-        rects_topleft = [(BLOCK_WIDTH * 4, - BLOCK_HEIGHT)]
-    elif block_type == 2:
-        rects_topleft = [(BLOCK_WIDTH * 3, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 4, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 6, - BLOCK_HEIGHT)]
-    elif block_type == 3:
-        rects_topleft = [(BLOCK_WIDTH * 4, 0),
-                         (BLOCK_WIDTH * 4, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, 0),
-                         (BLOCK_WIDTH * 5, - BLOCK_HEIGHT)]
-    elif block_type == 4:
-        rects_topleft = [(BLOCK_WIDTH * 4, BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 4, 0),
-                         (BLOCK_WIDTH * 4, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, BLOCK_HEIGHT)]
-    elif block_type == 5:
-        rects_topleft = [(BLOCK_WIDTH * 4, 0),
-                         (BLOCK_WIDTH * 4, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, 0)]
-    elif block_type == 6:
-        rects_topleft = [(BLOCK_WIDTH * 4, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 5, 0),
-                         (BLOCK_WIDTH * 5, - BLOCK_HEIGHT),
-                         (BLOCK_WIDTH * 6, - BLOCK_HEIGHT)]
-    return list(map(lambda rtl: Block(color, block_type, rtl), rects_topleft))
-
-
-def rotate_player_blocks(player_blocks: pygame.sprite.Group, placed_blocks: pygame.sprite.Group):
-    block_type = player_blocks.sprites()[0].block_type
-    if block_type in [1, 3]:
-        pass
-    elif block_type == 2:
-        new_player_blocks = pygame.sprite.Group()
-        if player_blocks.sprites()[0].rect.centerx < player_blocks.sprites()[-1].rect.centerx:
-            for i, block in enumerate(player_blocks):
-                # rotate vertically
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 2, BLOCK_HEIGHT * 2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        else:
-            for i, block in enumerate(player_blocks):
-                # rotate horizontally
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -2, BLOCK_HEIGHT * -2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        move = True
-        for block in new_player_blocks:
-            if pygame.sprite.spritecollideany(block, placed_blocks):
-                move = False
-        if move:
-            for i, block in enumerate(player_blocks):
-                player_blocks.sprites()[i].rect = new_player_blocks.sprites()[i].rect
-    elif block_type == 4:
-        new_player_blocks = pygame.sprite.Group()
-        if player_blocks.sprites()[0].rect.centerx < player_blocks.sprites()[-1].rect.centerx:
-            for i, block in enumerate(player_blocks):
-                # first left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 0)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 0, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 0, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[0].rect.centery > player_blocks.sprites()[-1].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # second left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * -2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 0, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 0)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -2, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[0].rect.centerx > player_blocks.sprites()[-1].rect.centerx:
-            for i, block in enumerate(player_blocks):
-                # third left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 0, BLOCK_HEIGHT * 2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[0].rect.centery < player_blocks.sprites()[-1].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # fourth left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 2, BLOCK_HEIGHT * 0)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        move = True
-        for block in new_player_blocks:
-            if pygame.sprite.spritecollideany(block, placed_blocks):
-                move = False
-        if move:
-            for i, block in enumerate(player_blocks):
-                player_blocks.sprites()[i].rect = new_player_blocks.sprites()[i].rect
-    elif block_type == 5:
-        new_player_blocks = pygame.sprite.Group()
-        if player_blocks.sprites()[0].rect.centery > player_blocks.sprites()[1].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # first left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 0)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[0].rect.centery < player_blocks.sprites()[1].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # second left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * -2)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 0)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-        move = True
-        for block in new_player_blocks:
-            if pygame.sprite.spritecollideany(block, placed_blocks):
-                move = False
-        if move:
-            for i, block in enumerate(player_blocks):
-                player_blocks.sprites()[i].rect = new_player_blocks.sprites()[i].rect
-    elif block_type == 6:
-        new_player_blocks = pygame.sprite.Group()
-        if player_blocks.sprites()[0].rect.centerx < player_blocks.sprites()[2].rect.centerx:
-            for i, block in enumerate(player_blocks):
-                # first left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[1].rect.centery > player_blocks.sprites()[2].rect.centery \
-                and player_blocks.sprites()[1].rect.centerx < player_blocks.sprites()[3].rect.centerx \
-                and player_blocks.sprites()[0].rect.centery < player_blocks.sprites()[3].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # second left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[1].rect.centerx < player_blocks.sprites()[2].rect.centerx < \
-                player_blocks.sprites()[3].rect.centerx \
-                and player_blocks.sprites()[1].rect.centerx < player_blocks.sprites()[3].rect.centerx:
-            for i, block in enumerate(player_blocks):
-                # third left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        elif player_blocks.sprites()[2].rect.centery < player_blocks.sprites()[3].rect.centery:
-            for i, block in enumerate(player_blocks):
-                # fourth left rotation
-                if i == 0:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * -1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 1:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * 1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-                if i == 2:
-                    new_block = copy.copy(block)
-                    new_player_blocks.add(new_block)
-                if i == 3:
-                    new_block = copy.copy(block)
-                    new_rect = block.rect.move(BLOCK_WIDTH * 1, BLOCK_HEIGHT * -1)
-                    new_block.rect = new_rect
-                    new_player_blocks.add(new_block)
-        move = True
-        for block in new_player_blocks:
-            if pygame.sprite.spritecollideany(block, placed_blocks):
-                move = False
-        if move:
-            for i, block in enumerate(player_blocks):
-                player_blocks.sprites()[i].rect = new_player_blocks.sprites()[i].rect
+def get_block(block_type: int, color: tuple[int, int, int], dx=0) -> list['Block']:
+    """Returns the blocks of a new piece, "dx" columns right of its position in PIECE_ROTATIONS"""
+    block_type = block_type if block_type in PIECE_ROTATIONS else 1
+    return [BLOCK_POOL.acquire(color, block_type, (BLOCK_WIDTH * (col + dx), BLOCK_HEIGHT * row))
+            for col, row in PIECE_ROTATIONS[block_type][0]]
+
+
+def piece_position(player_blocks: pygame.sprite.Group, board: 'Board') -> tuple[int, int, int, int] | None:
+    """Returns the (type, rotation state, column offset, row offset) of the player's piece, the offsets being from the
+    piece's cells in PIECE_STATES, or None if there is no piece"""
+    first_block = next(iter(player_blocks), None)
+    if first_block is None:
+        return None
+    rotation = first_block.rotation
+    cells = PIECE_STATES[first_block.block_type][rotation][0]
+    col, row = board.cell_of(first_block.rect)
+    return first_block.block_type, rotation, col - cells[0][0], row - cells[0][1]
+
+
+def rotate_piece(board: 'Board', block_type: int, rotation: int, dx: int, dy: int) -> tuple[int, int, int] | None:
+    """Returns the (rotation state, column offset, row offset) of a piece after rotating it, or None if it can't rotate.
+    The rotated piece is pushed back inside the walls and above the floor, then the wall kicks are tried in order until
+    one fits on the board."""
+    states = PIECE_STATES[block_type]
+    if len(states) == 1:
+        return None
+    rotation = (rotation + 1) % len(states)
+    cells, min_col, max_col, max_row = states[rotation]
+    dx += max(0, -(min_col + dx)) - max(0, max_col + dx - (board.width - 1))
+    dy -= max(0, max_row + dy - (board.height - 1))
+    for kick_x, kick_y in WALL_KICKS:
+        if board.fits(cells, dx + kick_x, dy + kick_y):
+            return rotation, dx + kick_x, dy + kick_y
+    return None
+
+
+def rotate_player_blocks(player_blocks: pygame.sprite.Group, board: 'Board'):
+    """Moves the player blocks to the next rotation state of their piece, see rotate_piece"""
+    position = piece_position(player_blocks, board)
+    if position is None or (rotated := rotate_piece(board, *position)) is None:
+        return
+    rotation, dx, dy = rotated
+    for block, (col, row) in zip(player_blocks, PIECE_STATES[position[0]][rotation][0]):
+        block.rect.topleft = (BLOCK_WIDTH * (col + dx), BLOCK_HEIGHT * (row + dy))
+        block.rotation = rotation
 
 
 class BlocksUpdater:
-    def __init__(self):
-        self.last_sideways_movement_time = pygame.time.get_ticks()
-        self.last_auto_down_movement_time = pygame.time.get_ticks()
-        self.last_down_movement_time = pygame.time.get_ticks()
-        self.last_down_drop_time = pygame.time.get_ticks()
-
-    def update_player_blocks(self, pressed_keys: Sequence[bool], player_blocks: pygame.sprite.Group,
-                             placed_blocks: pygame.sprite.Group):
-        if pygame.time.get_ticks() - self.last_auto_down_movement_time > 700:
+    """Moves the player's piece by the pressed keys. Every move happens in the step its key is pressed, even if it was
+    released again before the step, and repeats while the key is held: sideways after "das_ms" and then every
+    "arr_ms", the other moves every SOFT_DROP_MS, ROTATE_REPEAT_MS and HARD_DROP_REPEAT_MS."""
+
+    def __init__(self, clock=pygame.time, das_ms=DAS_MS, arr_ms=ARR_MS):
+        self.clock = clock
+        self.das_ms = das_ms
+        self.arr_ms = arr_ms
+        self.last_auto_down_movement_time = self.clock.get_ticks()
+        # time of the next repeat of every key held at the last step
+        self.next_repeats: dict[int, int] = {}
+
+    def repeats(self, pressed_keys: 'PressedKeys', key: int, delay: int, interval: int, limit: int) -> int:
+        """Returns how many times the move of "key" happens in this step, at most "limit" times"""
+        if not pressed_keys[key]:
+            self.next_repeats.pop(key, None)
+            return 0
+        now = self.clock.get_ticks()
+        if key not in self.next_repeats or key in pressed_keys.pressed:
+            self.next_repeats[key] = now + delay
+            return 1
+        next_repeat = self.next_repeats[key]
+        if now < next_repeat:
+            return 0
+        if interval <= 0:
+            return limit
+        count = (now - next_repeat) // interval + 1
+        self.next_repeats[key] = next_repeat + count * interval
+        return min(count, limit)
+
+    def update_player_blocks(self, pressed_keys: 'PressedKeys', player_blocks: pygame.sprite.Group, board: 'Board'):
+        if self.clock.get_ticks() - self.last_auto_down_movement_time > GRAVITY_MS:
             for block in player_blocks:
                 block.rect.move_ip(0, BLOCK_HEIGHT)
-            self.last_auto_down_movement_time = pygame.time.get_ticks()
+            self.last_auto_down_movement_time = self.clock.get_ticks()
 
-        if pressed_keys[pygame.K_DOWN] and pygame.time.get_ticks() - self.last_down_movement_time >= 70:
+        if soft_drops := self.repeats(pressed_keys, pygame.K_DOWN, SOFT_DROP_MS, SOFT_DROP_MS, board.height):
             for block in player_blocks:
-                block.rect.move_ip(0, BLOCK_HEIGHT)
-            self.last_down_movement_time = pygame.time.get_ticks()
-
-        if pressed_keys[pygame.K_d] and pygame.time.get_ticks() - self.last_down_drop_time >= 140:
-            player_bottom_sprts = group_bottom_sprites(player_blocks)
-            top_placed = []
-            for sprite in player_bottom_sprts:
-                top_placed.append(group_top(placed_blocks, sprite.rect))
-            top_placed = min(top_placed)
-            diff = top_placed - group_bottom(player_blocks)
+                block.rect.move_ip(0, BLOCK_HEIGHT * soft_drops)
+
+        if self.repeats(pressed_keys, pygame.K_d, HARD_DROP_REPEAT_MS, HARD_DROP_REPEAT_MS, 1):
+            diff = board.drop_distance(player_blocks) * BLOCK_HEIGHT
             for block in player_blocks:
                 block.rect.move_ip(0, diff)
-            self.last_down_drop_time = pygame.time.get_ticks()
 
-        if group_bottom_is_below_screen(player_blocks):
-            diff = group_bottom(player_blocks) - RESOLUTION[1]
+        if group_bottom_is_below_screen(player_blocks, board.pixel_height):
+            diff = group_bottom(player_blocks) - board.pixel_height
             for block in player_blocks:
                 block.rect.move_ip(0, -diff)
 
-        if pressed_keys[pygame.K_LEFT] and pressed_keys[pygame.K_RIGHT]:
-            return
-
-        if pressed_keys[pygame.K_SPACE] and pygame.time.get_ticks() - self.last_sideways_movement_time >= 200:
-            rotate_player_blocks(player_blocks, placed_blocks)
-            self.last_sideways_movement_time = pygame.time.get_ticks()
+        if self.repeats(pressed_keys, pygame.K_SPACE, ROTATE_REPEAT_MS, ROTATE_REPEAT_MS, 1):
+            rotate_player_blocks(player_blocks, board)
 
-        if pressed_keys[pygame.K_LEFT] and pygame.time.get_ticks() - self.last_sideways_movement_time >= 70:
-            move = True
-            for block in player_blocks:
-                moved_rect = block.rect.move(-BLOCK_WIDTH, 0)
-                sprt = pygame.sprite.Sprite()
-                sprt.rect = moved_rect
-                if pygame.sprite.spritecollideany(sprt, placed_blocks):
-                    move = False
-            if move:
-                for block in player_blocks:
-                    block.rect.move_ip(-BLOCK_WIDTH, 0)
-                self.last_sideways_movement_time = pygame.time.get_ticks()
-        elif pressed_keys[pygame.K_RIGHT] and pygame.time.get_ticks() - self.last_sideways_movement_time >= 70:
-            move = True
-            for block in player_blocks:
-                moved_rect = block.rect.move(BLOCK_WIDTH, 0)
-                sprt = pygame.sprite.Sprite()
-                sprt.rect = moved_rect
-                if pygame.sprite.spritecollideany(sprt, placed_blocks):
-                    move = False
-            if move:
-                for block in player_blocks:
-                    block.rect.move_ip(BLOCK_WIDTH, 0)
-                self.last_sideways_movement_time = pygame.time.get_ticks()
+        left = self.repeats(pressed_keys, pygame.K_LEFT, self.das_ms, self.arr_ms, board.width)
+        right = self.repeats(pressed_keys, pygame.K_RIGHT, self.das_ms, self.arr_ms, board.width)
+        if not (pressed_keys[pygame.K_LEFT] and pressed_keys[pygame.K_RIGHT]):
+            for dx, moves in ((-1, left), (1, right)):
+                for _ in range(moves):
+                    if not board.blocks_fit(player_blocks, dx, 0):
+                        break
+                    for block in player_blocks:
+                        block.rect.move_ip(BLOCK_WIDTH * dx, 0)
 
         if (left := group_left(player_blocks)) < 0:
             for block in player_blocks:
                 block.rect.move_ip(-left, 0)
 
-        if (right := group_right(player_blocks)) > RESOLUTION[0]:
-            diff = right - RESOLUTION[0]
+        if (right := group_right(player_blocks)) > board.pixel_width:
+            diff = right - board.pixel_width
             for block in player_blocks:
                 block.rect.move_ip(-diff, 0)
 
 
-class Congratulations:
+class DirtyRects:
+    """Tracks the screen regions that changed since the last presented frame, for presenting frames with
+    pygame.display.update(rects) instead of flipping the whole screen"""
+
+    def __init__(self, screen_rect: pygame.Rect):
+        self.screen_rect = screen_rect
+        self.full_screen = True
+        self.rects: list[pygame.Rect] = []
+        self.moving_rects: list[pygame.Rect] = []
+        self.last_moving_rects: list[pygame.Rect] = []
+        self.watched = {}
+
+    def add(self, rect: pygame.Rect):
+        if self.full_screen:
+            return
+        if len(self.rects) >= MAX_DIRTY_RECTS:
+            self.invalidate()
+            self.rects = []
+        else:
+            self.rects.append(rect)
+
+    def invalidate(self):
+        """Marks the whole screen as changed"""
+        self.full_screen = True
+
+    def set_moving(self, rects: list[pygame.Rect]):
+        """Sets where this frame's moving items (falling piece, drop preview, messages) were drawn. Their regions in
+        this and in the last frame are presented if they moved."""
+        self.moving_rects = rects
+
+    def watch(self, name: str, value, rect: pygame.Rect):
+        """Adds "rect", and the rect last watched under "name", if "value" changed since then"""
+        last_value, last_rect = self.watched.get(name, (self, rect))
+        if last_value != value:
+            self.watched[name] = value, rect
+            self.add(last_rect.union(rect))
+
+    def damaged(self) -> list[pygame.Rect]:
+        """Returns the regions that may differ from the background and the placed blocks: those drawn over in the last
+        frame (moving and watched items) and those changed since"""
+        return [*self.last_moving_rects, *self.rects, *(rect for _, rect in self.watched.values())]
+
+    def take(self) -> list[pygame.Rect]:
+        """Returns the regions to present for this frame and starts a new one, an empty list means nothing changed"""
+        if self.full_screen:
+            rects = [self.screen_rect]
+        else:
+            rects = self.rects
+            if self.moving_rects != self.last_moving_rects:
+                rects.extend(self.last_moving_rects)
+                rects.extend(self.moving_rects)
+        self.full_screen = False
+        self.rects = []
+        self.last_moving_rects = self.moving_rects
+        self.moving_rects = []
+        return rects
+
+
+class Profiler:
+    """Times the stages of every frame, keeps a histogram and the recent samples of each stage and draws them as an
+    overlay. A disabled profiler returns right away, so the timing calls can stay in the game loop:
+
+        start = profiler.start()
+        ...
+        start = profiler.lap('stage', start)"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.overlay = False
+        self.frames = 0
+        self.counts: dict[str, int] = {}
+        self.totals: dict[str, int] = {}
+        self.maximums: dict[str, int] = {}
+        self.histograms: dict[str, list[int]] = {}
+        self.recent: dict[str, deque[int]] = {}
+        self.overlay_lines: tuple[str, ...] = ()
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def lap(self, stage: str, start: int) -> int:
+        """Records the time since "start" for "stage" and returns the current time, the start of the next stage"""
+        if not self.enabled:
+            return 0
+        now = time.perf_counter_ns()
+        self.record(stage, now - start)
+        return now
+
+    def end_frame(self, start: int):
+        if self.enabled:
+            self.lap('frame', start)
+            self.frames += 1
+
+    def record(self, stage: str, ns: int):
+        if stage not in self.counts:
+            self.counts[stage] = self.totals[stage] = self.maximums[stage] = 0
+            self.histograms[stage] = [0] * PROFILE_BUCKETS
+            self.recent[stage] = deque(maxlen=PROFILE_WINDOW)
+        self.counts[stage] += 1
+        self.totals[stage] += ns
+        self.maximums[stage] = max(self.maximums[stage], ns)
+        self.histograms[stage][min((ns // 1000).bit_length(), PROFILE_BUCKETS - 1)] += 1
+        self.recent[stage].append(ns)
+
+    def percentiles(self, stage: str, percents=(50, 95, 99)) -> list[float]:
+        """Returns the percentiles of the recent samples of "stage" in ms"""
+        samples = sorted(self.recent.get(stage, ()))
+        if not samples:
+            return [0.0] * len(percents)
+        return [samples[min(len(samples) - 1, len(samples) * percent // 100)] / 1e6 for percent in percents]
+
+    def stages(self) -> list[str]:
+        return sorted(self.counts, key=lambda stage: (PROFILE_STAGES + (stage,)).index(stage))
+
+    def toggle_overlay(self):
+        self.overlay = self.enabled and not self.overlay
+
+    def draw_overlay(self, screen: pygame.Surface) -> pygame.Rect:
+        """Draws the p50/p95/p99 frame and stage times in the top right corner and returns where they were drawn. The
+        text is only updated every PROFILE_OVERLAY_REFRESH frames."""
+        if self.frames % PROFILE_OVERLAY_REFRESH == 0 or not self.overlay_lines:
+            self.overlay_lines = ('ms       p50    p95    p99',
+                                  *(f'{stage:<10} ' + ' '.join(f'{ms:6.2f}' for ms in self.percentiles(stage))
+                                    for stage in self.stages()))
+        scale = layout_scale(screen.get_size())
+        surfaces = [render_text(line, scale_size(14, scale), alpha=200) for line in self.overlay_lines]
+        rect = pygame.Rect(0, 0, max(surface.get_width() for surface in surfaces), 0)
+        rect.topright = screen.get_width() - scale_size(10, scale), scale_size(10, scale)
+        for surface in surfaces:
+            screen.blit(surface, (rect.left, rect.bottom))
+            rect.height += surface.get_height()
+        return rect
+
+    def summary(self) -> dict:
+        """Returns the timings of every stage: sample count, total, mean, maximum and recent percentiles in ms and
+        the histogram"""
+        stages = {}
+        for stage in self.stages():
+            p50, p95, p99 = self.percentiles(stage)
+            stages[stage] = {
+                'count': self.counts[stage],
+                'total_ms': self.totals[stage] / 1e6,
+                'mean_ms': self.totals[stage] / self.counts[stage] / 1e6,
+                'max_ms': self.maximums[stage] / 1e6,
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'p99_ms': p99,
+                'histogram': self.histograms[stage],
+            }
+        return {'frames': self.frames, 'bucket_upper_us': [2 ** i for i in range(PROFILE_BUCKETS)], 'stages': stages}
+
+    def export(self, path: str):
+        """Writes the summary as JSON, or the histograms as CSV rows of (stage, bucket upper bound in µs, count) if
+        "path" ends with .csv"""
+        summary = self.summary()
+        with open(path, 'w', newline='') as f:
+            if not path.endswith('.csv'):
+                json.dump(summary, f, indent=2)
+                return
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'bucket_upper_us', 'count'])
+            for stage, timings in summary['stages'].items():
+                for upper, count in zip(summary['bucket_upper_us'], timings['histogram']):
+                    if count:
+                        writer.writerow([stage, upper, count])
+
+
+class StartupTimer:
+    """Records when the startup steps finished, in ms since "start" """
+
+    def __init__(self, start: float):
+        self.start = start
+        self.marks: dict[str, float] = {}
+        self.reported = False
+
+    def mark(self, step: str):
+        """Records the first time "step" finished"""
+        if step not in self.marks:
+            self.marks[step] = (time.perf_counter() - self.start) * 1000
+
+    def report(self) -> str:
+        self.reported = True
+        steps = sorted(self.marks.items(), key=lambda item: item[1])
+        return 'startup: ' + ', '.join(f'{step} {ms:.1f} ms' for step, ms in steps)
+
+
+class AssetLoader:
+    """Loads the fonts and the background on a background thread, so the window and the first frames don't wait for
+    the system font lookup and the image decoding. background() returns a plain background until the image is loaded.
+    A failed load keeps its exception in "error" and can be started again."""
+
+    def __init__(self, startup: StartupTimer | None = None, font_sizes=FONT_SIZES):
+        self.startup = startup
+        self.font_sizes = font_sizes
+        self.fonts_ready = threading.Event()
+        self.loaded = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.attempts = 0
+        self.error: Exception | None = None
+        self.bg: pygame.Surface | None = None
+        self.converted = False
+        self.placeholder: pygame.Surface | None = None
+
+    def start(self):
+        """Starts loading, or loading again after a failed attempt"""
+        if self.loading():
+            raise RuntimeError("the assets are already loading")
+        self.attempts += 1
+        self.error = None
+        self.thread = threading.Thread(target=self._load, name='assets', daemon=True)
+        self.thread.start()
+
+    def loading(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def _load(self):
+        try:
+            if not self.fonts_ready.is_set():
+                for size in self.font_sizes:
+                    get_font(size)
+                self._mark('fonts')
+                self.fonts_ready.set()
+            self.bg = load_bg()
+            self._mark('background')
+            self.loaded.set()
+        except Exception as err:
+            self.error = err
+
+    def _mark(self, step: str):
+        if self.startup:
+            self.startup.mark(step)
+
+    def background(self) -> pygame.Surface:
+        if not self.loaded.is_set():
+            if self.placeholder is None:
+                self.placeholder = get_plain_bg()
+            return self.placeholder
+        if not self.converted:
+            # converted to the display format on the main thread
+            self.bg = self.bg.convert() if pygame.display.get_surface() else self.bg
+            self.converted = True
+        return self.bg
+
+
+class StaticLayer:
+    """The background, scaled to cover the screen, with the grid drawn over it, composited once into a single surface
+    and only rebuilt when the screen size, the background, the area of the grid or its cell size changes. Viewports
+    scroll in whole cells, so scrolling doesn't change the grid."""
+
     def __init__(self):
+        self.surface: pygame.Surface | None = None
+        self.size = None
+        self.bg = None
+        self.grid_area = None
+        self.cell_size = None
+
+    def get(self, size: tuple[int, int], bg: pygame.Surface, grid_area: pygame.Rect | None = None,
+            cell_size=(RESOLUTION[0] // BLOCKS_HORIZONTAL, RESOLUTION[1] // BLOCKS_VERTICAL)) -> pygame.Surface:
+        if self.surface is None or size != self.size or bg is not self.bg or grid_area != self.grid_area \
+                or cell_size != self.cell_size:
+            surface = pygame.Surface(size)
+            scaled = bg
+            if bg.get_size() != size:
+                # the aspect ratio is kept, the sides that don't fit are cut off
+                scale = max(size[0] / bg.get_width(), size[1] / bg.get_height())
+                scaled = pygame.transform.smoothscale(bg, (math.ceil(bg.get_width() * scale),
+                                                           math.ceil(bg.get_height() * scale)))
+            surface.blit(scaled, scaled.get_rect(center=surface.get_rect().center))
+            draw_grid(surface, cell_size, grid_area)
+            self.surface = surface.convert() if pygame.display.get_surface() else surface
+            self.size = size
+            self.bg = bg
+            self.grid_area = grid_area
+            self.cell_size = cell_size
+        return self.surface
+
+
+class Viewport:
+    """The part of the board shown on the screen, in whole cells, and the mapping of board coordinates to screen pixels.
+    Cells are scaled like the whole RESOLUTION layout fitted into the screen, rounded to whole pixels so the tiles line
+    up. Boards larger than the screen scroll to keep the player's piece VIEWPORT_MARGIN cells inside the viewport,
+    smaller ones are centered on the screen."""
+
+    def __init__(self, board: 'Board', screen_size: tuple[int, int]):
+        self.board = board
+        # top left cell shown
+        self.col = 0
+        self.row = 0
+        self.resize(screen_size)
+
+    def resize(self, screen_size: tuple[int, int]):
+        board = self.board
+        self.screen_size = tuple(screen_size)
+        scale = layout_scale(screen_size)
+        self.cell_size = scale_size(BLOCK_WIDTH, scale), scale_size(BLOCK_HEIGHT, scale)
+        # screen pixels per unit of board coordinates
+        self.scale = self.cell_size[0] / BLOCK_WIDTH, self.cell_size[1] / BLOCK_HEIGHT
+        self.cols = min(board.width, screen_size[0] // self.cell_size[0])
+        self.rows = min(board.height, screen_size[1] // self.cell_size[1])
+        # screen area the board is drawn in
+        self.area = pygame.Rect(0, 0, self.cols * self.cell_size[0], self.rows * self.cell_size[1])
+        self.area.center = screen_size[0] // 2, screen_size[1] // 2
+        self.col = max(0, min(self.col, board.width - self.cols))
+        self.row = max(0, min(self.row, board.height - self.rows))
+        self._update_offset()
+
+    def _update_offset(self):
+        # screen position of the board's top left corner
+        self.offset = self.area.left - self.col * self.cell_size[0], self.area.top - self.row * self.cell_size[1]
+
+    def follow(self, blocks) -> bool:
+        """Scrolls to keep the blocks in view, returns whether the viewport moved"""
+        if not blocks or (self.cols == self.board.width and self.rows == self.board.height):
+            return False
+        cells = [self.board.cell_of(block.rect) for block in blocks]
+        col = self._follow(self.col, self.cols, self.board.width, VIEWPORT_MARGIN[0], [col for col, _ in cells])
+        row = self._follow(self.row, self.rows, self.board.height, VIEWPORT_MARGIN[1], [row for _, row in cells])
+        if (col, row) == (self.col, self.row):
+            return False
+        self.col, self.row = col, row
+        self._update_offset()
+        return True
+
+    @staticmethod
+    def _follow(start: int, size: int, board_size: int, margin: int, cells: list[int]) -> int:
+        margin = min(margin, (size - 1) // 2)
+        start = min(start, min(cells) - margin)
+        start = max(start, max(cells) + margin - size + 1)
+        return max(0, min(start, board_size - size))
+
+    def to_screen(self, rect: pygame.Rect) -> pygame.Rect:
+        """Returns the screen rect of a rect in board coordinates"""
+        left, top = self.to_screen_point(rect.left, rect.top)
+        right, bottom = self.to_screen_point(rect.right, rect.bottom)
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def to_screen_point(self, x: float, y: float) -> tuple[int, int]:
+        return self.offset[0] + round(x * self.scale[0]), self.offset[1] + round(y * self.scale[1])
+
+    def visible_rows(self, area: pygame.Rect | None = None) -> range:
+        """Returns the rows shown, or only those overlapping "area" of the screen"""
+        if area is None:
+            return range(self.row, self.row + self.rows)
+        height, top = self.cell_size[1], self.offset[1]
+        return range(max(self.row, (area.top - top) // height),
+                     min(self.row + self.rows, (area.bottom - 1 - top) // height + 1))
+
+    def visible_cols(self, area: pygame.Rect | None = None) -> range:
+        """Returns the columns shown, or only those overlapping "area" of the screen"""
+        if area is None:
+            return range(self.col, self.col + self.cols)
+        width, left = self.cell_size[0], self.offset[0]
+        return range(max(self.col, (area.left - left) // width),
+                     min(self.col + self.cols, (area.right - 1 - left) // width + 1))
+
+
+class Congratulations:
+    def __init__(self, clock=pygame.time):
+        self.clock = clock
         self.time_start_display = None
         self.displayed = False
         self.message_list = ["Great!", "Keep it up!", "Way to go!", "I'm proud of you!",
@@ -670,65 +1190,909 @@ class Congratulations:
         self.active = False
 
     def _write_message(self, screen, message):
-        font = pygame.font.SysFont('arial', 48)
-        text_surface = font.render(message, True, (255, 255, 255), (0, 0, 0))
-        text_surface.set_alpha(200)
-        text_rect = text_surface.get_rect(center=(RESOLUTION[0] / 2, (RESOLUTION[1] / 2)))
+        text_surface = render_text(message, scale_size(48, layout_scale(screen.get_size())), alpha=200)
+        text_rect = text_surface.get_rect(center=screen.get_rect().center)
         screen.blit(text_surface, text_rect)
+        return text_rect
 
-    def display(self, screen):
+    def display(self, screen) -> pygame.Rect | None:
+        """Draws the current message, if any, and returns where it was drawn"""
         if self.active:
-            time = pygame.time.get_ticks()
+            time = self.clock.get_ticks()
             if self.displayed and time - self.time_start_display < 1000:
-                self._write_message(screen, self.message)
+                return self._write_message(screen, self.message)
             elif self.displayed:
                 self.time_start_display = None
                 self.displayed = False
                 self.message = None
                 self.active = False
             elif not self.displayed:
-                self.time_start_display = pygame.time.get_ticks()
+                self.time_start_display = self.clock.get_ticks()
                 self.displayed = True
                 self.message = random.choice(self.message_list)
-                self._write_message(screen, self.message)
+                return self._write_message(screen, self.message)
+        return None
+
+
+@functools.lru_cache(maxsize=BLOCK_SURFACE_CACHE_SIZE)
+def get_block_surface(color: tuple[int, int, int], size=(BLOCK_WIDTH, BLOCK_HEIGHT)) -> pygame.Surface:
+    """Returns the bevelled block tile of "color" and "size" in screen pixels, shared by all the blocks of that color.
+    The surface must not be modified."""
+    surf = pygame.Surface(size)
+    rect = surf.get_rect()
+    surf.fill(color, rect)
+    surf.fill((250, 250, 250), pygame.Rect(1, 1, rect.width - 2, 1))
+    surf.fill((250, 250, 250), pygame.Rect(rect.width - 2, 1, 1, rect.height - 2))
+    surf.fill((5, 5, 5), pygame.Rect(1, 1, 1, rect.height - 2))
+    surf.fill((5, 5, 5), pygame.Rect(1, rect.height - 2, rect.width - 2, 1))
+    return surf
 
 
 class Block(pygame.sprite.Sprite):
+    """A cell of the player's piece, "rect" is in board coordinates"""
+
     def __init__(self, color, block_type, rect_topleft=(BLOCK_WIDTH * 4, - BLOCK_HEIGHT)):
         super().__init__()
-        self.surf = pygame.Surface((BLOCK_WIDTH, BLOCK_HEIGHT))
-        self.rect = self.surf.get_rect(topleft=rect_topleft)
-        self.surf.fill(color, self.surf.get_rect())
-        self.surf.fill((250, 250, 250), pygame.Rect(1, 1, self.rect.width - 2, 1))
-        self.surf.fill((250, 250, 250), pygame.Rect(self.rect.width - 2, 1, 1, self.rect.height - 2))
-        self.surf.fill((5, 5, 5), pygame.Rect(1, 1, 1, self.rect.height - 2))
-        self.surf.fill((5, 5, 5), pygame.Rect(1, self.rect.height - 2, self.rect.width - 2, 1))
+        self.rect = pygame.Rect(0, 0, BLOCK_WIDTH, BLOCK_HEIGHT)
+        self.reset(color, block_type, rect_topleft)
+
+    def reset(self, color, block_type, rect_topleft):
+        self.rect.topleft = rect_topleft
         self.block_type = block_type
+        self.rotation = 0
+        self.color = color
+
+
+class BlockPool:
+    """Keeps the blocks removed from the game (cleared lines, restarts) to reuse them for new pieces"""
+
+    def __init__(self, max_size=BLOCK_POOL_SIZE):
+        self.max_size = max_size
+        self.free: list[Block] = []
+
+    def acquire(self, color, block_type, rect_topleft) -> Block:
+        if self.free:
+            block = self.free.pop()
+            block.reset(color, block_type, rect_topleft)
+            return block
+        return Block(color, block_type, rect_topleft)
+
+    def release(self, *blocks: Block):
+        """Removes the blocks from all their groups and keeps them for reuse"""
+        for block in blocks:
+            block.kill()
+            if len(self.free) < self.max_size:
+                self.free.append(block)
+
+
+BLOCK_POOL = BlockPool()
+
+
+class Board:
+    """Occupancy grid of the placed blocks, row 0 being the top row of the screen.
+
+    "cells" holds the color of every placed block (None for empty cells) and "row_counts" the number of filled cells
+    per row, so complete rows are found without scanning the board. "column_tops" is the skyline: the row of the highest
+    placed block of every column (the board height for empty columns). Placed blocks are only kept as colors, they are
+    drawn straight from the grid."""
+
+    def __init__(self, width=BLOCKS_HORIZONTAL, height=BLOCKS_VERTICAL):
+        if not (MIN_BOARD_SIZE[0] <= width <= MAX_BOARD_SIZE[0] and MIN_BOARD_SIZE[1] <= height <= MAX_BOARD_SIZE[1]):
+            raise ValueError(f"board size {width}x{height} is out of range")
+        self.width = width
+        self.height = height
+        self.pixel_width = width * BLOCK_WIDTH
+        self.pixel_height = height * BLOCK_HEIGHT
+        # columns new pieces are moved right of their PIECE_ROTATIONS cells, to center them on the board
+        self.spawn_dx = (width - BLOCKS_HORIZONTAL) // 2
+        self.cells: list[list[tuple[int, int, int] | None]] = [[None] * width for _ in range(height)]
+        self.row_counts = [0] * height
+        self.column_tops = [height] * width
+
+    @staticmethod
+    def cell_of(rect: pygame.Rect) -> tuple[int, int]:
+        """Returns the (column, row) of the cell at the top left of "rect" """
+        return int(rect.left // BLOCK_WIDTH), int(rect.top // BLOCK_HEIGHT)
+
+    def is_occupied(self, col: int, row: int) -> bool:
+        """Cells outside the walls and below the floor count as occupied, cells above the board are free"""
+        if col < 0 or col >= self.width or row >= self.height:
+            return True
+        return row >= 0 and self.cells[row][col] is not None
+
+    def fits(self, cells, dx=0, dy=0) -> bool:
+        """Checks if the (column, row) cells moved by "dx", "dy" are all free"""
+        for col, row in cells:
+            if self.is_occupied(col + dx, row + dy):
+                return False
+        return True
+
+    def blocks_fit(self, blocks, dx=0, dy=0) -> bool:
+        """Checks if the blocks moved by "dx" columns and "dy" rows are all on free cells"""
+        for block in blocks:
+            col, row = self.cell_of(block.rect)
+            if self.is_occupied(col + dx, row + dy):
+                return False
+        return True
+
+    def collides(self, blocks) -> bool:
+        """Checks if any of the blocks overlaps a placed block"""
+        for block in blocks:
+            col, row = self.cell_of(block.rect)
+            if 0 <= col < self.width and 0 <= row < self.height and self.cells[row][col] is not None:
+                return True
+        return False
+
+    def floor_below(self, col: int, row: int) -> int:
+        """Returns the row of the first placed block below "row" in column "col" (the board height if there is none).
+        Constant time unless the cell is under an overhang."""
+        top = self.column_tops[col]
+        if row < top:
+            return top
+        row += 1
+        while row < self.height and self.cells[row][col] is None:
+            row += 1
+        return row
+
+    def drop_distance(self, blocks) -> int:
+        """Returns how many rows the blocks can fall before landing on the floor or a placed block"""
+        distance = self.height
+        for block in blocks:
+            col, row = self.cell_of(block.rect)
+            if 0 <= col < self.width:
+                distance = min(distance, self.floor_below(col, row) - row - 1)
+        return distance
+
+    def lock(self, blocks) -> list[int]:
+        """Places the colors of the blocks on the board, releases the blocks to BLOCK_POOL and returns the rows they
+        completed, from top to bottom. Blocks outside the board or on an occupied cell are ignored."""
+        touched_rows = set()
+        for block in blocks:
+            col, row = self.cell_of(block.rect)
+            if not (0 <= col < self.width and 0 <= row < self.height) or self.cells[row][col] is not None:
+                continue
+            self.cells[row][col] = block.color
+            self.row_counts[row] += 1
+            if row < self.column_tops[col]:
+                self.column_tops[col] = row
+            touched_rows.add(row)
+        BLOCK_POOL.release(*blocks)
+        return sorted(row for row in touched_rows if self.row_counts[row] == self.width)
+
+    def clear_rows(self, rows: list[int]):
+        """Removes the given rows and adds as many empty rows at the top. Only the row lists move, not the cells, so
+        this costs the same on a board of any width."""
+        if not rows:
+            return
+        for row in sorted(rows, reverse=True):
+            del self.cells[row]
+            del self.row_counts[row]
+        self.cells[:0] = [[None] * self.width for _ in rows]
+        self.row_counts[:0] = [0] * len(rows)
+        # complete rows are below every column's top, so the tops move down by at least the number of cleared rows
+        for col, top in enumerate(self.column_tops):
+            if top < self.height:
+                top += len(rows)
+                while top < self.height and self.cells[top][col] is None:
+                    top += 1
+                self.column_tops[col] = top
+
+    def clear(self):
+        self.cells = [[None] * self.width for _ in range(self.height)]
+        self.row_counts = [0] * self.height
+        self.column_tops = [self.height] * self.width
 
 
 class Game:
-    def __init__(self, resolution):
-        self.screen = pygame.display.set_mode(resolution)
+    def __init__(self, resolution, headless=False, clock=pygame.time, seed=None, vsync=False,
+                 board_size=(BLOCKS_HORIZONTAL, BLOCKS_VERTICAL), das_ms=DAS_MS, arr_ms=ARR_MS,
+                 screen: pygame.Surface | None = None, fullscreen=False):
+        """With "headless" the game draws to an off-screen surface instead of opening a window, "screen" if given
+        (it must be "resolution" large), a new one otherwise. The window is resizable, "fullscreen" opens it at the
+        resolution of the display, with "vsync" the display scales "resolution" frames instead. "clock" is anything
+        with a get_ticks() method returning milliseconds (pygame.time or a VirtualClock). "board_size" is the
+        (columns, rows) of the board, "das_ms" and "arr_ms" the sideways key repeat, see BlocksUpdater."""
+        if headless:
+            self.screen = screen if screen is not None else pygame.Surface(resolution)
+        else:
+            flags = pygame.RESIZABLE | (pygame.SCALED if vsync else 0)
+            if fullscreen:
+                flags |= pygame.FULLSCREEN
+                if not vsync:
+                    resolution = 0, 0
+            self.screen = pygame.display.set_mode(resolution, flags, vsync=int(vsync))
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.recorder: Recorder | None = None
+        self.telemetry: Telemetry | None = None
+        # file F5 saves a Snapshot to and F9 loads it from, None to disable them
+        self.state_path: str | None = None
+        # input events waiting for the next step of the game rules and the time not yet simulated
+        self.input_events: list[pygame.event.Event] = []
+        self.keyboard = KeyboardInput()
+        self.accumulator = 0
+        # positions of the player blocks before the last step, for drawing between steps
+        self.previous_positions: dict[Block, tuple[int, int]] = {}
 
         self.player_blocks = pygame.sprite.Group()
-        self.placed_blocks = pygame.sprite.Group()
+        self.board = Board(*board_size)
+        self.viewport = Viewport(self.board, self.screen.get_size())
         self.all_sprites = pygame.sprite.Group()
 
-        self.player_blocks.add(*create_player_blocks())
+        self.player_blocks.add(*create_player_blocks(self.rng, self.board.spawn_dx))
         self.all_sprites.add(*self.player_blocks)
+        # counts the pieces since the game was created, restarts included
+        self.pieces_spawned = 0
+        # plays instead of the keyboard if set
+        self.autoplayer: Autoplayer | None = None
+
+        self.blocks_updater = BlocksUpdater(clock, das_ms, arr_ms)
+        self.congratulations = Congratulations(clock)
+        self.static_layer = StaticLayer()
+        self.dirty_rects = DirtyRects(self.screen.get_rect())
+        self.profiler = Profiler()
 
-        self.blocks_updater = BlocksUpdater()
-        self.congratulations = Congratulations()
+    def resize(self, screen: pygame.Surface):
+        """Draws the game on "screen" from now on, the window after it changed size"""
+        self.screen = screen
+        self.viewport.resize(screen.get_size())
+        self.dirty_rects.screen_rect = screen.get_rect()
+        self.dirty_rects.invalidate()
 
 
 class GameState:
     def __init__(self):
         self.score = 0
         self.record = 0
+        self.lines_cleared = 0
+        self.pieces_placed = 0
         self.dead = False
         self.running = True
         self.started = False
 
 
+class VirtualClock:
+    """Stand-in for pygame.time whose time only moves when advanced, so games can run faster than real time"""
+
+    def __init__(self, ticks=0):
+        self.ticks = ticks
+
+    def get_ticks(self) -> int:
+        return self.ticks
+
+    def advance(self, ms: int):
+        self.ticks += ms
+
+
+class PressedKeys:
+    """Key state of one step of the game rules, indexable like the result of pygame.key.get_pressed(). "keys" are the
+    keys held during the step, "pressed" those pressed again since the last step although they look held throughout,
+    because they were released and pressed again in between. Indexing is also true for the pressed keys."""
+
+    def __init__(self, keys=(), pressed=()):
+        self.keys = frozenset(keys)
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.keys or key in self.pressed
+
+
+class KeyboardInput:
+    """Builds the PressedKeys of every step from KEYDOWN and KEYUP events, so a key pressed and released between two
+    steps still counts as pressed for one step instead of being missed like with pygame.key.get_pressed().
+
+    With "timed" it also keeps when every game key press was picked up (perf_counter_ns), for measuring the latency
+    until the first frame showing its step is presented, take_shown() must then be called every frame."""
+
+    def __init__(self, timed=False):
+        self.held: set[int] = set()
+        self.pressed: set[int] = set()
+        self.released: set[int] = set()
+        self.timed = timed
+        self.waiting: list[int] = []
+        self.stepped: list[int] = []
+
+    def handle(self, event: pygame.event.Event):
+        if event.type == pygame.KEYDOWN and event.key in GAME_KEYS:
+            if event.key in self.held or event.key in self.released:
+                self.pressed.add(event.key)
+            self.held.add(event.key)
+            if self.timed:
+                self.waiting.append(time.perf_counter_ns())
+        elif event.type == pygame.KEYUP and event.key in self.held:
+            self.held.discard(event.key)
+            self.released.add(event.key)
+
+    def reset(self):
+        """Forgets the held keys, for a new game"""
+        self.held.clear()
+        self.pressed.clear()
+        self.released.clear()
+        self.waiting.clear()
+
+    def take(self) -> PressedKeys:
+        """Returns the key state for the next step: held keys and keys pressed since the last step"""
+        keys = PressedKeys(self.held | self.released, self.pressed)
+        self.pressed.clear()
+        self.released.clear()
+        self.stepped.extend(self.waiting)
+        self.waiting.clear()
+        return keys
+
+    def take_shown(self) -> list[int]:
+        """Returns the pick up times of the presses handled by the steps since the last call"""
+        stepped, self.stepped = self.stepped, []
+        return stepped
+
+
+class Autoplayer:
+    """Plays the game instead of the keyboard. On every new piece it tries every rotation state the piece can rotate to
+    where it is and every column it can then move to, drops it there on a copy of the board and scores the resulting
+    board by its aggregate height, holes, bumpiness and cleared lines. keys() then returns the keys that rotate, move
+    and drop the piece to the best placement.
+
+    The search stops after "budget_ms" (None for no limit) with the best placement found so far. Evaluated boards
+    are not kept: a board almost never comes up again in a later search, the placed pieces differ."""
+
+    def __init__(self, budget_ms: float | None = AUTOPLAY_BUDGET_MS, weights=AUTOPLAY_WEIGHTS):
+        self.budget_ms = budget_ms
+        self.weights = weights
+        self.last_search_ms = 0.0
+        self.piece = None
+        # (rotation state, column offset) the current piece is moved to
+        self.target: tuple[int, int] | None = None
+
+    def keys(self, game) -> set[int]:
+        """Returns the keys to hold for the next step of "game" """
+        position = piece_position(game.player_blocks, game.board)
+        if position is None:
+            return set()
+        if game.pieces_spawned != self.piece:
+            self.piece = game.pieces_spawned
+            self.target = self.search(game.board, *position)
+        block_type, rotation, dx, dy = position
+        target_rotation, target_dx = self.target
+        if rotation != target_rotation:
+            if rotate_piece(game.board, *position) is not None:
+                return {pygame.K_SPACE}
+        elif dx != target_dx:
+            step = 1 if target_dx > dx else -1
+            if game.board.fits(PIECE_STATES[block_type][rotation][0], dx + step, dy):
+                return {pygame.K_RIGHT if step > 0 else pygame.K_LEFT}
+        else:
+            return {pygame.K_d, pygame.K_DOWN}
+        # the piece got stuck on the way, it is dropped where it is
+        self.target = rotation, dx
+        return {pygame.K_d, pygame.K_DOWN}
+
+    def search(self, board: 'Board', block_type: int, rotation: int, dx: int, dy: int) -> tuple[int, int]:
+        """Returns the (rotation state, column offset) of the best placement of the piece"""
+        start = time.perf_counter()
+        deadline = None if self.budget_ms is None else start + self.budget_ms / 1000
+        # pieces land at most 4 rows above the highest placed block, the rows above that are left out
+        top = max(0, min(board.column_tops) - 4)
+        rows = [sum(1 << col for col, cell in enumerate(row) if cell is not None) for row in board.cells[top:]]
+        states = PIECE_STATES[block_type]
+        best_score, best = float('-inf'), (rotation, dx)
+        position = rotation, dx, dy
+        for _ in range(len(states)):
+            rotation, dx, dy = position
+            cells = states[rotation][0]
+            for step in (-1, 1):
+                column = dx if step < 0 else dx + 1
+                while board.fits(cells, column, dy):
+                    score = self.score(board, rows, top, cells, column, dy)
+                    if score > best_score:
+                        best_score, best = score, (rotation, column)
+                    if deadline is not None and time.perf_counter() > deadline:
+                        self.last_search_ms = (time.perf_counter() - start) * 1000
+                        return best
+                    column += step
+            if (position := rotate_piece(board, block_type, rotation, dx, dy)) is None:
+                break
+        self.last_search_ms = (time.perf_counter() - start) * 1000
+        return best
+
+    def score(self, board: 'Board', rows: list[int], top: int, cells, dx: int, dy: int) -> float:
+        """Drops the cells moved by "dx", "dy" like a hard drop and scores the board, given as the bit masks of the rows
+        from "top" down, with the piece locked there"""
+        dy += min(board.floor_below(col + dx, row + dy) - row - dy - 1 for col, row in cells)
+        if any(row + dy < 0 for _, row in cells):
+            # locking a piece above the board ends the game
+            return float('-inf')
+        placed = rows.copy()
+        for col, row in cells:
+            placed[row + dy - top] |= 1 << col + dx
+        full = (1 << board.width) - 1
+        remaining = [row for row in placed if row != full]
+        lines = len(rows) - len(remaining)
+        # empty rows don't change the score
+        first = next((i for i, row in enumerate(remaining) if row), len(remaining))
+        return self.evaluate(remaining[first:], board.width) + self.weights['lines'] * lines
+
+    def evaluate(self, rows: list[int], width: int) -> float:
+        heights = [0] * width
+        holes = 0
+        covered = 0
+        for i, row in enumerate(rows):
+            new = row & ~covered
+            while new:
+                col = (new & -new).bit_length() - 1
+                heights[col] = len(rows) - i
+                new &= new - 1
+            holes += (covered & ~row).bit_count()
+            covered |= row
+        bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+        return (self.weights['height'] * sum(heights) + self.weights['holes'] * holes
+                + self.weights['bumpiness'] * bumpiness)
+
+
+class HeadlessGame:
+    """Runs the game rules without a window, one frame per step() and with a virtual clock.
+
+    Only needs pygame itself, no display or video driver. A HeadlessGame started with the same seed and driven with the
+    same keys plays out exactly the same. Games that are never rendered can use a tiny "resolution" to save the memory
+    of the off-screen surface."""
+
+    def __init__(self, seed=None, frame_ms=STEP_MS, board_size=(BLOCKS_HORIZONTAL, BLOCKS_VERTICAL),
+                 resolution=RESOLUTION, das_ms=DAS_MS, arr_ms=ARR_MS, screen: pygame.Surface | None = None):
+        self.frame_ms = frame_ms
+        self.clock = VirtualClock()
+        if screen is not None:
+            resolution = screen.get_size()
+        self.game = Game(resolution, headless=True, clock=self.clock, seed=seed, board_size=board_size, das_ms=das_ms,
+                         arr_ms=arr_ms, screen=screen)
+        self.game_state = GameState()
+        self.game_state.started = True
+
+    def step(self, keys=(), events=(), ms=None, pressed=()) -> 'GameState':
+        """Advances the game by one frame of "ms" (frame_ms by default) with "keys" held down, "pressed" are keys
+        released and pressed again since the last step and "events" extra pygame events for this frame. Does nothing
+        once the game is over."""
+        if not self.game_state.dead:
+            self.clock.advance(self.frame_ms if ms is None else ms)
+            step_game(events, PressedKeys(keys, pressed), self.game, self.game_state)
+        return self.game_state
+
+    def restart(self):
+        restart_game(self.game, self.game_state)
+
+    def snapshot(self) -> 'Snapshot':
+        return Snapshot.take(self.game, self.game_state)
+
+    def restore(self, snapshot: 'Snapshot'):
+        snapshot.restore(self.game, self.game_state)
+
+    def clone(self, resolution=(1, 1)) -> 'HeadlessGame':
+        """Returns an independent copy of the game that plays on exactly like this one. Only the game state is copied,
+        the clone draws to a new surface of "resolution", too small to be rendered unless given a larger one."""
+        board, updater = self.game.board, self.game.blocks_updater
+        clone = HeadlessGame(seed=0, frame_ms=self.frame_ms, board_size=(board.width, board.height),
+                             resolution=resolution, das_ms=updater.das_ms, arr_ms=updater.arr_ms)
+        self.snapshot().restore(clone.game, clone.game_state)
+        return clone
+
+    def render(self, bg: pygame.Surface | None = None) -> pygame.Surface:
+        """Draws the current frame to the off-screen surface, needs pygame.font to be initialized"""
+        draw_game(bg or get_bg(), self.game, self.game_state)
+        return self.game.screen
+
+
+def write_varint(out: bytearray, value: int):
+    """Appends a non-negative integer in 7 bits per byte, least significant first"""
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Returns the integer at "pos" written by write_varint and the position after it"""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+class Recorder:
+    """Records a game as a compact binary stream that replay.py plays back.
+
+    The stream starts with REPLAY_MAGIC, the format version, the game seed, the board width and height and the DAS and
+    ARR in ms. Frames follow as runs of identical frames: the run length, the held GAME_KEYS as bits followed by the
+    pressed again ones as bits and the frame time in ms as the difference to the previous run's. A run length of 0
+    starts a marker instead, followed by a byte with the type of the spawned piece or REPLAY_RESTART."""
+
+    def __init__(self, seed: int, board_size=(BLOCKS_HORIZONTAL, BLOCKS_VERTICAL), das_ms=DAS_MS, arr_ms=ARR_MS):
+        self.data = bytearray(REPLAY_MAGIC)
+        self.data.append(REPLAY_VERSION)
+        write_varint(self.data, zigzag(seed))
+        for value in (*board_size, das_ms, arr_ms):
+            write_varint(self.data, value)
+        self.last_ticks = 0
+        self.last_frame_ms = 0
+        self.run = None
+        self.run_length = 0
+
+    def tick(self, pressed_keys: PressedKeys, ticks: int):
+        keys = 0
+        for bit, key in enumerate(GAME_KEYS):
+            if pressed_keys[key]:
+                keys |= 1 << bit
+            if key in pressed_keys.pressed:
+                keys |= 1 << bit + len(GAME_KEYS)
+        frame = keys, ticks - self.last_ticks
+        self.last_ticks = ticks
+        if frame != self.run:
+            self._flush()
+            self.run = frame
+        self.run_length += 1
+
+    def spawn(self, block_type: int):
+        self._marker(block_type)
+
+    def restart(self):
+        self._marker(REPLAY_RESTART)
+
+    def getvalue(self) -> bytes:
+        self._flush()
+        return bytes(self.data)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.getvalue())
+
+    def _marker(self, code: int):
+        self._flush()
+        self.data.append(0)
+        self.data.append(code)
+
+    def _flush(self):
+        if self.run_length:
+            keys, frame_ms = self.run
+            write_varint(self.data, self.run_length)
+            write_varint(self.data, keys)
+            write_varint(self.data, zigzag(frame_ms - self.last_frame_ms))
+            self.last_frame_ms = frame_ms
+            self.run_length = 0
+
+
+class Telemetry:
+    """Writes the game events of TELEMETRY_EVENTS to rotating log files without ever blocking the game.
+
+    emit() only appends the event to a queue of at most "queue_size" events, events that don't fit are dropped and
+    counted. A writer thread takes the queued events every TELEMETRY_FLUSH_MS and writes them in one batch, as JSON
+    lines ({"time": unix time, "ticks": game time in ms, "event": name, and its values}) or, if "path" ends with .bin,
+    as records of the event's index in TELEMETRY_EVENTS, the unix time and the game time in ms and the event's values
+    as varints, each file starting with TELEMETRY_MAGIC and the format version. Files reaching "max_bytes" are renamed
+    to "path".1 (the older ones to .2 and so on, keeping "backups" of them) and a new file is started. A file left at
+    "path" by an earlier run is rotated the same way before the first write.
+
+    Dropped events are logged as a "dropped" event with the number of events dropped since the last one."""
+
+    def __init__(self, path: str, max_bytes=TELEMETRY_FILE_SIZE, backups=TELEMETRY_BACKUPS,
+                 queue_size=TELEMETRY_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.binary = path.endswith('.bin')
+        # appending to and popping from a deque are atomic, the game thread never waits for the writer
+        self.queue: deque[tuple] = deque()
+        self.dropped = 0
+        self.logged_dropped = 0
+        self.file = None
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self.thread.start()
+
+    def emit(self, event: str, ticks: int, *values: int):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append((event, time.time(), ticks, values))
+
+    def close(self):
+        """Writes the queued events and stops the writer"""
+        self.closed.set()
+        self.thread.join()
+
+    def _run(self):
+        try:
+            while not self.closed.wait(TELEMETRY_FLUSH_MS / 1000):
+                self._flush()
+            self._flush()
+        finally:
+            if self.file:
+                self.file.close()
+
+    def _flush(self):
+        batch = []
+        queue = self.queue
+        while queue:
+            batch.append(queue.popleft())
+        if self.dropped != self.logged_dropped:
+            dropped = self.dropped
+            batch.append(('dropped', time.time(), batch[-1][2] if batch else 0, (dropped - self.logged_dropped,)))
+            self.logged_dropped = dropped
+        if not batch:
+            return
+        if self.file is None:
+            self._rotate()
+        # written in as few writes as the rotations allow
+        data = bytearray()
+        size = self.file.tell()
+        for record in map(self._encode, batch):
+            if size + len(data) + len(record) > self.max_bytes and size + len(data) > self._header_size():
+                self.file.write(data)
+                data.clear()
+                self._rotate()
+                size = self.file.tell()
+            data += record
+        self.file.write(data)
+        self.file.flush()
+
+    def _encode(self, record: tuple) -> bytes:
+        event, wall_time, ticks, values = record
+        if not self.binary:
+            fields = {'time': round(wall_time, 3), 'ticks': ticks, 'event': event}
+            fields.update(zip(TELEMETRY_EVENTS[event], values))
+            return (json.dumps(fields) + '\n').encode()
+        data = bytearray([TELEMETRY_EVENT_CODES[event]])
+        write_varint(data, int(wall_time * 1000))
+        write_varint(data, ticks)
+        for value in values:
+            write_varint(data, value)
+        return data
+
+    def _header_size(self) -> int:
+        return len(TELEMETRY_MAGIC) + 1 if self.binary else 0
+
+    def _rotate(self):
+        if self.file:
+            self.file.close()
+        if self.backups and os.path.exists(self.path):
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+        if self.binary:
+            self.file.write(TELEMETRY_MAGIC + bytes([TELEMETRY_VERSION]))
+
+    @staticmethod
+    def read(path: str) -> list[dict]:
+        """Returns the events of a log file in either format as dicts like the JSON lines, "time" in seconds"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(TELEMETRY_MAGIC):
+            return [json.loads(line) for line in data.splitlines()]
+        if data[len(TELEMETRY_MAGIC)] != TELEMETRY_VERSION:
+            raise ValueError(f"unsupported telemetry version {data[len(TELEMETRY_MAGIC)]}")
+        events = list(TELEMETRY_EVENTS.items())
+        records = []
+        pos = len(TELEMETRY_MAGIC) + 1
+        while pos < len(data):
+            event, names = events[data[pos]]
+            wall_time, pos = read_varint(data, pos + 1)
+            ticks, pos = read_varint(data, pos)
+            record = {'time': wall_time / 1000, 'ticks': ticks, 'event': event}
+            for name in names:
+                record[name], pos = read_varint(data, pos)
+            records.append(record)
+        return records
+
+
+class Snapshot:
+    """The complete state of a game at the end of a frame: the board, the player's piece, the movement timers, the
+    score and the piece generator. Restoring it into any Game (of any board size) continues
+    exactly like the original, so snapshots are used both to save games to disk and to branch positions in memory.
+
+    Snapshots are immutable and hold no sprites or surfaces, only tuples: taking and restoring one costs a copy of the
+    board's rows and the generator state. Presentation state (the viewport, the congratulations message, the profiler)
+    is not included."""
+    __slots__ = ('board_size', 'cells', 'row_counts', 'column_tops', 'piece', 'ticks', 'gravity_age', 'repeats',
+                 'pieces_spawned', 'scores', 'dead', 'rng_state')
+
+    def __init__(self, board_size, cells, row_counts, column_tops, piece, ticks, gravity_age, repeats, pieces_spawned,
+                 scores, dead, rng_state):
+        self.board_size: tuple[int, int] = board_size
+        self.cells: tuple[tuple[tuple[int, int, int] | None, ...], ...] = cells
+        self.row_counts: tuple[int, ...] = row_counts
+        self.column_tops: tuple[int, ...] = column_tops
+        # (type, rotation state, color, top left of every block in the group's order) or None
+        self.piece: tuple[int, int, tuple[int, int, int], tuple[tuple[int, int], ...]] | None = piece
+        # the clock time, how long ago the piece last fell and the held keys with the time until their next repeat
+        self.ticks: int = ticks
+        self.gravity_age: int = gravity_age
+        self.repeats: tuple[tuple[int, int], ...] = repeats
+        self.pieces_spawned: int = pieces_spawned
+        # score, record, cleared lines and placed pieces
+        self.scores: tuple[int, int, int, int] = scores
+        self.dead: bool = dead
+        self.rng_state = rng_state
+
+    @classmethod
+    def take(cls, game: Game, game_state: GameState) -> 'Snapshot':
+        board = game.board
+        blocks = list(game.player_blocks)
+        piece = None
+        if blocks:
+            piece = (blocks[0].block_type, blocks[0].rotation, blocks[0].color,
+                     tuple(block.rect.topleft for block in blocks))
+        ticks = game.clock.get_ticks()
+        return cls(
+            (board.width, board.height),
+            tuple(map(tuple, board.cells)),
+            tuple(board.row_counts),
+            tuple(board.column_tops),
+            piece,
+            ticks,
+            ticks - game.blocks_updater.last_auto_down_movement_time,
+            tuple((key, next_repeat - ticks) for key, next_repeat in game.blocks_updater.next_repeats.items()),
+            game.pieces_spawned,
+            (game_state.score, game_state.record, game_state.lines_cleared, game_state.pieces_placed),
+            game_state.dead,
+            game.rng.getstate(),
+        )
+
+    def restore(self, game: Game, game_state: GameState):
+        """Replaces the state of "game" and "game_state" with this one. A VirtualClock is set to the snapshot's time,
+        other clocks keep their time and the timers are set relative to it."""
+        board = game.board
+        if (board.width, board.height) != self.board_size:
+            board = game.board = Board(*self.board_size)
+            game.viewport = Viewport(board, game.screen.get_size())
+        board.cells = [list(row) for row in self.cells]
+        board.row_counts = list(self.row_counts)
+        board.column_tops = list(self.column_tops)
+
+        BLOCK_POOL.release(*game.player_blocks)
+        if self.piece:
+            block_type, rotation, color, positions = self.piece
+            blocks = [BLOCK_POOL.acquire(color, block_type, topleft) for topleft in positions]
+            for block in blocks:
+                block.rotation = rotation
+            game.player_blocks.add(*blocks)
+            game.all_sprites.add(*blocks)
+        game.previous_positions = {}
+
+        if isinstance(game.clock, VirtualClock):
+            game.clock.ticks = self.ticks
+        ticks = game.clock.get_ticks()
+        game.blocks_updater.last_auto_down_movement_time = ticks - self.gravity_age
+        game.blocks_updater.next_repeats = {key: ticks + wait for key, wait in self.repeats}
+        game.pieces_spawned = self.pieces_spawned
+        game.rng.setstate(self.rng_state)
+
+        game_state.score, game_state.record, game_state.lines_cleared, game_state.pieces_placed = self.scores
+        game_state.dead = self.dead
+        game.congratulations.active = game.congratulations.displayed = False
+        game.dirty_rects.invalidate()
+
+    def to_bytes(self) -> bytes:
+        """Encodes the snapshot as SNAPSHOT_MAGIC, the format version and varints: the board width and height, every
+        row as its number of placed blocks followed by the column and color of each, the number of blocks of the piece
+        followed by its type, rotation state, color and the zigzag top left of each block, the clock time, the zigzag
+        time since the piece last fell, the number of held keys followed by each key and the zigzag time until it
+        repeats, the spawned pieces, the scores, a byte for game over and the generator's state as 32 bit words."""
+        data = bytearray(SNAPSHOT_MAGIC)
+        data.append(SNAPSHOT_VERSION)
+        for value in self.board_size:
+            write_varint(data, value)
+        for row, count in zip(self.cells, self.row_counts):
+            write_varint(data, count)
+            if count:
+                for col, color in enumerate(row):
+                    if color is not None:
+                        write_varint(data, col)
+                        data.extend(color)
+        if self.piece:
+            block_type, rotation, color, positions = self.piece
+            write_varint(data, len(positions))
+            data.append(block_type)
+            data.append(rotation)
+            data.extend(color)
+            for left, top in positions:
+                write_varint(data, zigzag(left))
+                write_varint(data, zigzag(top))
+        else:
+            write_varint(data, 0)
+        write_varint(data, self.ticks)
+        write_varint(data, zigzag(self.gravity_age))
+        write_varint(data, len(self.repeats))
+        for key, wait in self.repeats:
+            write_varint(data, key)
+            write_varint(data, zigzag(wait))
+        for value in (self.pieces_spawned, *self.scores):
+            write_varint(data, value)
+        data.append(self.dead)
+        rng_version, words, gauss_next = self.rng_state
+        data.append(rng_version)
+        data.extend(struct.pack(f'<{len(words)}I', *words))
+        data.extend(struct.pack('<?d', gauss_next is not None, gauss_next or 0.0))
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Snapshot':
+        """Decodes a snapshot written by to_bytes, raises ValueError if "data" isn't one"""
+        if len(data) <= len(SNAPSHOT_MAGIC) or data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("not a saved game")
+        if data[len(SNAPSHOT_MAGIC)] != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported saved game version {data[len(SNAPSHOT_MAGIC)]}")
+        try:
+            pos = len(SNAPSHOT_MAGIC) + 1
+            width, pos = read_varint(data, pos)
+            height, pos = read_varint(data, pos)
+            board = Board(width, height)
+            for row in range(height):
+                count, pos = read_varint(data, pos)
+                for _ in range(count):
+                    col, pos = read_varint(data, pos)
+                    if col >= width:
+                        raise ValueError(f"saved block in column {col} of a {width} columns board")
+                    board.cells[row][col] = tuple(data[pos:pos + 3])
+                    pos += 3
+                    board.row_counts[row] += 1
+                    board.column_tops[col] = min(board.column_tops[col], row)
+            count, pos = read_varint(data, pos)
+            piece = None
+            if count:
+                block_type, rotation, color = data[pos], data[pos + 1], tuple(data[pos + 2:pos + 5])
+                if block_type not in PIECE_ROTATIONS or rotation >= len(PIECE_ROTATIONS[block_type]):
+                    raise ValueError(f"invalid saved piece: type {block_type}, rotation state {rotation}")
+                pos += 5
+                positions = []
+                for _ in range(count):
+                    left, pos = read_varint(data, pos)
+                    top, pos = read_varint(data, pos)
+                    positions.append((unzigzag(left), unzigzag(top)))
+                piece = block_type, rotation, color, tuple(positions)
+            ticks, pos = read_varint(data, pos)
+            gravity_age, pos = read_varint(data, pos)
+            count, pos = read_varint(data, pos)
+            repeats = []
+            for _ in range(count):
+                key, pos = read_varint(data, pos)
+                wait, pos = read_varint(data, pos)
+                repeats.append((key, unzigzag(wait)))
+            values = []
+            for _ in range(5):
+                value, pos = read_varint(data, pos)
+                values.append(value)
+            pieces_spawned, *scores = values
+            dead = bool(data[pos])
+            rng_version = data[pos + 1]
+            pos += 2
+            words_size = struct.calcsize('<625I')
+            words = struct.unpack_from('<625I', data, pos)
+            has_gauss, gauss_next = struct.unpack_from('<?d', data, pos + words_size)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated saved game") from e
+        return cls((width, height), tuple(map(tuple, board.cells)), tuple(board.row_counts), tuple(board.column_tops),
+                   piece, ticks, unzigzag(gravity_age), tuple(repeats), pieces_spawned, tuple(scores), dead,
+                   (rng_version, words, gauss_next if has_gauss else None))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path) -> 'Snapshot':
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,141 @@
+"""Runs seeded headless games for autoplay policies in parallel and prints a summary table.
+
+Usage: uv run tournament.py --policies random drop search --games 200 [--workers 8] [--json results.json]"""
+import argparse
+import json
+import random
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pygame
+
+from tetris import Autoplayer, HeadlessGame
+
+MAX_FRAMES = 60 * 60 * 60
+
+
+class RandomPolicy:
+    """Holds a random key, or none, every frame"""
+    keys = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_SPACE, pygame.K_DOWN, pygame.K_d)
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def __call__(self, headless_game: HeadlessGame) -> set[int]:
+        return {self.rng.choice(self.keys)} if self.rng.random() < 0.3 else set()
+
+
+class DropPolicy:
+    """Drops every piece where it spawns"""
+
+    def __init__(self, seed):
+        pass
+
+    def __call__(self, headless_game: HeadlessGame) -> set[int]:
+        return {pygame.K_d}
+
+
+class SearchPolicy:
+    """Plays with the Autoplayer's placement search. The search has no time limit here, so the results don't depend on
+    the speed of the machine."""
+
+    def __init__(self, seed):
+        self.autoplayer = Autoplayer(budget_ms=None)
+
+    def __call__(self, headless_game: HeadlessGame) -> set[int]:
+        return self.autoplayer.keys(headless_game.game)
+
+
+POLICIES = {
+    'random': RandomPolicy,
+    'drop': DropPolicy,
+    'search': SearchPolicy,
+}
+
+
+def play_game(policy_name: str, seed: int, max_frames=MAX_FRAMES) -> dict:
+    """Plays one game until game over or "max_frames" and returns its results. Only depends on its arguments, so it
+    gives the same results in any worker process."""
+    start = time.perf_counter()
+    headless_game = HeadlessGame(seed=seed)
+    policy = POLICIES[policy_name](seed)
+    game_state = headless_game.game_state
+    frames = 0
+    while frames < max_frames and not game_state.dead:
+        headless_game.step(policy(headless_game))
+        frames += 1
+    return {
+        'policy': policy_name,
+        'seed': seed,
+        'score': game_state.score,
+        'lines': game_state.lines_cleared,
+        'pieces': game_state.pieces_placed,
+        'frames': frames,
+        'wall_time': time.perf_counter() - start,
+    }
+
+
+def run_tournament(policy_names: list[str], seeds: list[int], workers=None, max_frames=MAX_FRAMES) -> list[dict]:
+    """Plays every policy on every seed across a process pool, results are ordered by policy and seed"""
+    jobs = [(name, seed) for name in policy_names for seed in seeds]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(play_game, name, seed, max_frames) for name, seed in jobs]
+        return [future.result() for future in futures]
+
+
+def summarize(results: list[dict]) -> list[dict]:
+    summary = []
+    for name in dict.fromkeys(result['policy'] for result in results):
+        games = [result for result in results if result['policy'] == name]
+        scores = [game['score'] for game in games]
+        summary.append({
+            'policy': name,
+            'games': len(games),
+            'mean_score': statistics.fmean(scores),
+            'median_score': statistics.median(scores),
+            'max_score': max(scores),
+            'mean_lines': statistics.fmean(game['lines'] for game in games),
+            'mean_pieces': statistics.fmean(game['pieces'] for game in games),
+            'wall_time': sum(game['wall_time'] for game in games),
+        })
+    return summary
+
+
+def format_table(rows: list[dict]) -> str:
+    if not rows:
+        return 'no games played'
+    header = list(rows[0])
+    cells = [[f'{row[key]:.2f}' if isinstance(row[key], float) else str(row[key]) for key in header] for row in rows]
+    widths = [max(len(key), *(len(line[i]) for line in cells)) for i, key in enumerate(header)]
+    lines = ['  '.join(key.rjust(width) for key, width in zip(header, widths))]
+    lines.extend('  '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--policies', nargs='+', default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument('--games', type=int, default=100, help='number of games per policy')
+    parser.add_argument('--first-seed', type=int, default=0, help='games use seeds first-seed ... first-seed+games-1')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the number of cores')
+    parser.add_argument('--max-frames', type=int, default=MAX_FRAMES, help='frames after which a game is stopped')
+    parser.add_argument('--json', help='also write the per-game results and the summary to this file')
+    args = parser.parse_args()
+    if args.games < 1:
+        parser.error("--games must be at least 1")
+
+    seeds = list(range(args.first_seed, args.first_seed + args.games))
+    start = time.perf_counter()
+    results = run_tournament(args.policies, seeds, args.workers, args.max_frames)
+    summary = summarize(results)
+    print(format_table(summary))
+    print(f'{len(results)} games in {time.perf_counter() - start:.2f}s')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'summary': summary, 'games': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()